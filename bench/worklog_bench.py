@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmark of the worklog plugin hot paths on a synthetic work log.
+
+Fills the work log of a project in a scratch EduTrac environment with
+generated sessions, then times `WorkLogManager` calls and web handlers
+and prints the results as JSON:
+
+    python bench/worklog_bench.py /path/to/env --project 1 --rows 100000
+
+The environment needs the plugin enabled and upgraded, and the project
+needs some tickets and users; sessions are generated over those. The
+plugin SQL needs PostgreSQL, so use a scratch copy of a PostgreSQL
+backed environment. Everything runs in a single transaction which is
+rolled back at the end unless `--keep` is given.
+'''
+import random
+import sys
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from StringIO import StringIO
+from time import time
+
+from trac.env import Environment
+from trac.test import Mock, MockPerm
+from trac.ticket import Ticket
+from trac.util.datefmt import utc
+from trac.util.presentation import to_json
+from trac.web.api import RequestDone
+from trac.web.href import Href
+
+from trac.project.api import ProjectManagement
+
+from worklog.manager import WorkLogManager
+from worklog.timeline_hook import WorkLogTimelineAddon
+from worklog.webui import WorkLogPage
+
+
+# Sessions are spread over the last two years
+SPAN = 2 * 365 * 86400
+
+
+class Rollback(Exception):
+    '''Raised to discard the generated data.'''
+
+
+def generate(db, pid, users, tickets, rows, seed):
+    '''Insert `rows` finished work sessions of `users` on `tickets`,
+    spread evenly over the `SPAN` seconds before now, and point
+    `work_log_latest` to the last ones.'''
+    rnd = random.Random(seed)
+    now = int(time())
+    per_user = max(rows // len(users), 1)
+    # Sessions get denser with more rows instead of going further back
+    step = max(SPAN // per_user, 2)
+    cursor = db.cursor()
+    count = 0
+    for user in users:
+        t = now - per_user * step
+        batch = []
+        last = None
+        for i in xrange(per_user):
+            if count >= rows:
+                break
+            start = t + rnd.randint(0, min(step // 4, 1800))
+            end = start + rnd.randint(1, max(min(step // 2, 5400), 1))
+            ticket = rnd.choice(tickets)
+            batch.append((user, ticket, pid, end, start, end, 'Session %d' % i))
+            last = (ticket, start)
+            t += step
+            count += 1
+            if len(batch) >= 10000:
+                cursor.executemany('INSERT INTO work_log (worker, ticket, project_id, '
+                                   'lastchange, starttime, endtime, comment) '
+                                   'VALUES (%s, %s, %s, %s, %s, %s, %s)', batch)
+                batch = []
+        if batch:
+            cursor.executemany('INSERT INTO work_log (worker, ticket, project_id, '
+                               'lastchange, starttime, endtime, comment) '
+                               'VALUES (%s, %s, %s, %s, %s, %s, %s)', batch)
+        if last:
+            cursor.execute('UPDATE work_log_latest SET ticket=%s, starttime=%s '
+                           'WHERE project_id=%s AND worker=%s',
+                           (last[0], last[1], pid, user))
+            if cursor.rowcount == 0:
+                cursor.execute('INSERT INTO work_log_latest (project_id, worker, ticket, starttime) '
+                               'VALUES (%s, %s, %s, %s)', (pid, user, last[0], last[1]))
+    return count
+
+
+def make_req(username, sink, **kwargs):
+    req = Mock(authname=username, perm=MockPerm(), args={}, tz=utc,
+               href=Href('/trac'), abs_href=Href('http://localhost/trac'),
+               chrome={}, form_token=None, is_ajax=False, locale=None,
+               session={}, method='GET',
+               send_response=lambda code: None,
+               send_header=lambda name, value: None,
+               end_headers=lambda: None,
+               check_modified=lambda *args: None,
+               write=sink.write,
+               send=lambda content, *args: sink.write(content))
+    req.__dict__.update(kwargs)
+    return req
+
+
+def measure(func, repeat, before=None):
+    times = []
+    for i in xrange(repeat):
+        if before:
+            before()
+        start = time()
+        func()
+        times.append(time() - start)
+    times.sort()
+    return {'repeat': repeat,
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1]}
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] ENV')
+    parser.add_option('--project', type='int', help='project id')
+    parser.add_option('--rows', type='int', default=10000,
+                      help='number of work_log rows to generate [%default]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs of each operation [%default]')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--keep', action='store_true',
+                      help='commit the generated rows')
+    parser.add_option('--output', help='write the results to a file')
+    options, args = parser.parse_args(args)
+    if len(args) != 1 or options.project is None:
+        parser.error('environment path and --project are required')
+
+    env = Environment(args[0])
+    pid = options.project
+    pm = ProjectManagement(env)
+    mgr = WorkLogManager(env)
+    page = WorkLogPage(env)
+    page.pm = pm
+    timeline = WorkLogTimelineAddon(env)
+    results = {'rows': options.rows, 'project': pid, 'repeat': options.repeat,
+               'operations': {}}
+
+    def run(db):
+        users = sorted(pm.get_project_users(pid))
+        cursor = db.cursor()
+        cursor.execute('SELECT id FROM ticket WHERE project_id=%s', (pid,))
+        tickets = [row[0] for row in cursor]
+        if not users or not tickets:
+            raise ValueError('Project %s has no users or tickets' % pid)
+
+        start = time()
+        results['generated'] = generate(db, pid, users, tickets,
+                                        options.rows, options.seed)
+        results['generate_seconds'] = time() - start
+        cursor.execute('ANALYZE work_log')
+
+        user = users[0]
+        tkt = Ticket(env, tickets[0])
+        sink = StringIO()
+        ops = results['operations']
+
+        def new_request():
+            # Work done once per request, like the generation check
+            mgr.pre_process_request(None, None)
+            sink.seek(0)
+            sink.truncate()
+
+        def cold_request():
+            new_request()
+            mgr.active_cache.clear()
+
+        def handler(func, *args, **kwargs):
+            def call():
+                try:
+                    func(*args, **kwargs)
+                except RequestDone:
+                    pass
+            return call
+
+        to = datetime.now(utc)
+        since = to - timedelta(days=30)
+        cases = [
+            ('who_is_working_on', lambda: mgr.who_is_working_on(tkt.id, pid), new_request),
+            ('who_is_working_on_many', lambda: mgr.who_is_working_on_many(tickets[:100]), new_request),
+            ('get_active_task.cold', lambda: mgr.get_active_task(user, pid), cold_request),
+            ('get_active_task.warm', lambda: mgr.get_active_task(user, pid), new_request),
+            ('get_latest_task', lambda: mgr.get_latest_task(user, pid), new_request),
+            ('get_work_log.latest', lambda: mgr.get_work_log(pid, mode='latest'), new_request),
+            ('get_work_log.user', lambda: mgr.get_work_log(pid, user, mode='user', limit=100), new_request),
+            ('get_work_log.all', lambda: mgr.get_work_log(pid, limit=100), new_request),
+            ('get_report.user', lambda: mgr.get_report(pid, 'user'), new_request),
+            ('get_report.week', lambda: mgr.get_report(pid, 'week'), new_request),
+            ('timeline.30days', lambda: list(timeline.get_timeline_events(
+                    make_req(user, sink), since, to, ['workstart', 'workstop'], pid, None)),
+                new_request),
+            ('web.status', handler(page._work_status, make_req(user, sink), tkt.id), new_request),
+            ('web.csv', handler(page._worklog_csv, make_req(user, sink), pid), new_request),
+            ('web.json', handler(page._worklog_json, make_req(user, sink), pid), new_request),
+        ]
+        for name, func, before in cases:
+            ops[name] = measure(func, options.repeat, before)
+            ops[name]['bytes'] = sink.tell() or None
+            sys.stderr.write('%-28s %.4fs\n' % (name, ops[name]['median']))
+
+        if not options.keep:
+            raise Rollback
+
+    try:
+        env.with_transaction()(run)
+    except Rollback:
+        pass
+
+    output = to_json(results)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,44 @@
 #!/usr/bin/env python
 
+import imp
+import os
+
+from distutils.cmd import Command
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 PACKAGE = 'worklog'
 
+
+class build_assets(Command):
+    description = 'build minified, content hashed static file bundles'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        # Loaded directly, the package itself needs Trac
+        base = os.path.dirname(os.path.abspath(__file__))
+        assets = imp.load_source('%s_assets' % PACKAGE,
+                                 os.path.join(base, PACKAGE, 'assets.py'))
+        manifest = assets.build_bundles(os.path.join(base, PACKAGE, 'htdocs'))
+        for name, filename in sorted(manifest.items()):
+            self.announce('built %s as %s' % (name, filename), 2)
+
+
+class build_py_assets(build_py):
+
+    def run(self):
+        self.run_command('build_assets')
+        # Built bundles are package data too, let them be collected again
+        self.__dict__.pop('data_files', None)
+        build_py.run(self)
+
+
 setup(name='EduTracTicketWorklog',
       description='Plugin to manage the which tickets users are currently working on',
       keywords='trac plugin ticket working log',
@@ -13,7 +48,9 @@ setup(name='EduTracTicketWorklog',
       author='Colin Guthrie, Aleksey A. Porfirov',
       author_email='lexqt@yandex.ru',
       packages=[PACKAGE],
-      package_data={PACKAGE : ['templates/*.cs', 'templates/*.html', 'htdocs/*.css', 'htdocs/*.png', 'htdocs/*.js']},
+      package_data={PACKAGE : ['templates/*.cs', 'templates/*.html', 'htdocs/*.css', 'htdocs/*.png', 'htdocs/*.js', 'htdocs/*.json']},
+      cmdclass={'build_assets': build_assets, 'build_py': build_py_assets},
+      test_suite='worklog.tests.suite',
       entry_points={'trac.plugins': '%s = %s' % (PACKAGE, PACKAGE)})
 
 
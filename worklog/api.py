@@ -7,6 +7,10 @@ from trac.env import IEnvironmentSetupParticipant
 
 from usermanual import *
 from manager import *
+from notification import *
+from reaper import *
+from stats import *
+from bundles import *
 from webui import *
 from webadminui import *
 from ticket_filter import *
@@ -22,7 +26,7 @@ class WorkLogSetupParticipant(Component):
     implements(IEnvironmentSetupParticipant)
 
     db_version_key = 'TicketWorklogPlugin'
-    db_version = 1
+    db_version = 11
 
     """Extension point interface for components that need to participate in the
     creation and upgrading of Trac environments, for example to create
@@ -62,6 +66,111 @@ class WorkLogSetupParticipant(Component):
                            'comment    TEXT,'
                            'CONSTRAINT work_log_pk PRIMARY KEY (worker, ticket, lastchange)'
                            ')')
+        if self.db_installed_version < 2:
+            print 'Creating indexes for open work sessions lookups'
+            # Partial indexes only hold open sessions (endtime=0), so
+            # "who is working on" and "active task" lookups stay cheap
+            # regardless of the work_log history size.
+            cursor.execute('CREATE INDEX work_log_open_ticket_idx '
+                           'ON work_log (ticket) WHERE endtime=0')
+            cursor.execute('CREATE INDEX work_log_open_worker_idx '
+                           'ON work_log (worker) WHERE endtime=0')
+            cursor.execute('CREATE INDEX work_log_worker_lastchange_idx '
+                           'ON work_log (worker, lastchange)')
+        if self.db_installed_version < 3:
+            print 'Creating active work sessions generation counter'
+            cursor.execute("INSERT INTO system (name,value) VALUES(%s,%s)",
+                           ('TicketWorklogPlugin.generation', 0))
+        if self.db_installed_version < 4:
+            print 'Creating index for work log paging'
+            cursor.execute('CREATE INDEX work_log_lastchange_idx '
+                           'ON work_log (lastchange)')
+        if self.db_installed_version < 5:
+            print 'Creating index for work log date filters'
+            cursor.execute('CREATE INDEX work_log_starttime_idx '
+                           'ON work_log (starttime)')
+        if self.db_installed_version < 6:
+            print 'Creating work_log_rollup table'
+            cursor.execute('CREATE TABLE work_log_rollup ('
+                           'project_id INTEGER,'
+                           'worker     VARCHAR(255),'
+                           'ticket     INTEGER,'
+                           'day        INTEGER,'
+                           'seconds    INTEGER,'
+                           'sessions   INTEGER,'
+                           'CONSTRAINT work_log_rollup_pk PRIMARY KEY (project_id, worker, ticket, day)'
+                           ')')
+            print 'Computing work_log_rollup from work_log'
+            WorkLogManager(self.env).rebuild_rollups(db)
+        if self.db_installed_version < 7:
+            print 'Creating index for timeline work stop events'
+            cursor.execute('CREATE INDEX work_log_endtime_idx '
+                           'ON work_log (endtime)')
+        if self.db_installed_version < 8:
+            print 'Creating work_log_notify table'
+            cursor.execute('CREATE TABLE work_log_notify ('
+                           'ticket       INTEGER,'
+                           'modtime      BIGINT,'
+                           'attempts     INTEGER,'
+                           'next_attempt INTEGER,'
+                           'error        TEXT,'
+                           'CONSTRAINT work_log_notify_pk PRIMARY KEY (ticket, modtime)'
+                           ')')
+        if self.db_installed_version < 9:
+            print 'Adding project_id to work_log'
+            cursor.execute('ALTER TABLE work_log ADD COLUMN project_id INTEGER')
+            cursor.execute('UPDATE work_log SET project_id='
+                           '(SELECT project_id FROM ticket WHERE ticket.id=work_log.ticket)')
+            print 'Closing duplicate open work sessions'
+            # Only the latest open session of a ticket and of a worker in
+            # a project is kept, others are closed with zero duration
+            cursor.execute('UPDATE work_log SET endtime=starttime '
+                           'WHERE endtime=0 AND EXISTS ('
+                           'SELECT 1 FROM work_log wl WHERE wl.endtime=0 AND wl.ticket=work_log.ticket '
+                           'AND (wl.starttime>work_log.starttime OR '
+                           '(wl.starttime=work_log.starttime AND wl.worker>work_log.worker)))')
+            cursor.execute('UPDATE work_log SET endtime=starttime '
+                           'WHERE endtime=0 AND EXISTS ('
+                           'SELECT 1 FROM work_log wl WHERE wl.endtime=0 AND wl.worker=work_log.worker '
+                           'AND wl.project_id=work_log.project_id '
+                           'AND (wl.starttime>work_log.starttime OR '
+                           '(wl.starttime=work_log.starttime AND wl.ticket>work_log.ticket)))')
+            print 'Creating unique indexes on open work sessions'
+            cursor.execute('DROP INDEX work_log_open_ticket_idx')
+            cursor.execute('CREATE UNIQUE INDEX work_log_open_ticket_idx '
+                           'ON work_log (ticket) WHERE endtime=0')
+            cursor.execute('CREATE UNIQUE INDEX work_log_open_project_worker_idx '
+                           'ON work_log (project_id, worker) WHERE endtime=0')
+        if self.db_installed_version < 10:
+            print 'Creating work_log_latest table'
+            # Latest work session of each worker in a project, so the work
+            # log landing page does not scan the whole project history
+            cursor.execute('CREATE TABLE work_log_latest ('
+                           'project_id INTEGER,'
+                           'worker     VARCHAR(255) REFERENCES users (username) ON DELETE CASCADE ON UPDATE CASCADE,'
+                           'ticket     INTEGER REFERENCES ticket (id) ON DELETE CASCADE,'
+                           'starttime  INTEGER,'
+                           'CONSTRAINT work_log_latest_pk PRIMARY KEY (project_id, worker)'
+                           ')')
+            cursor.execute('CREATE INDEX work_log_worker_starttime_idx '
+                           'ON work_log (worker, starttime)')
+            print 'Filling work_log_latest from work_log'
+            cursor.execute('INSERT INTO work_log_latest (project_id, worker, ticket, starttime) '
+                           'SELECT DISTINCT ON (project_id, worker) project_id, worker, ticket, starttime '
+                           'FROM work_log '
+                           'WHERE project_id IS NOT NULL '
+                           'ORDER BY project_id, worker, lastchange DESC, starttime DESC')
+        if self.db_installed_version < 11:
+            print 'Creating work_log_generation table'
+            # Open sessions generation of each project replaces the global
+            # one, so a change invalidates cached sessions of its project only
+            cursor.execute('CREATE TABLE work_log_generation ('
+                           'project_id INTEGER,'
+                           'generation INTEGER,'
+                           'CONSTRAINT work_log_generation_pk PRIMARY KEY (project_id)'
+                           ')')
+            cursor.execute('DELETE FROM system WHERE name=%s',
+                           ('TicketWorklogPlugin.generation',))
 
         # Updates complete, set the version
         cursor.execute("UPDATE system SET value=%s WHERE name=%s", 
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''Static file bundles of the plugin.
+
+This module does not import Trac, so `setup.py` loads it to build the
+bundles before the package data is collected.'''
+import os
+import re
+from hashlib import sha1
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# Bundle name and its source files in the htdocs directory. The
+# worklog-stop bundles are loaded only when the stop work popup opens.
+BUNDLES = [
+    ('worklog.js',       ['tracWorklog.js']),
+    ('worklog.css',      ['worklogplugin.css']),
+    ('worklog-stop.js',  ['jqModal.js',
+                          'jquery.mousewheel.pack.js',
+                          'jquery.timeentry.pack.js']),
+    ('worklog-stop.css', ['jqModal.css']),
+]
+
+# Maps bundle names to hashed file names of the built bundles
+MANIFEST = 'bundles.json'
+
+
+def minify_js(text):
+    '''Minify using `rjsmin` or `jsmin` if installed.'''
+    try:
+        from rjsmin import jsmin
+    except ImportError:
+        try:
+            from jsmin import jsmin
+        except ImportError:
+            return text
+    return jsmin(text)
+
+def minify_css(text):
+    text = re.compile(r'/\*.*?\*/', re.S).sub('', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip()
+
+def hashed_name(name, content):
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, sha1(content).hexdigest()[:10], ext)
+
+def build_bundles(htdocs_dir):
+    '''Write minified, content hashed bundles and their manifest to
+    `htdocs_dir`. Returns the manifest.'''
+    manifest = {}
+    for name, sources in BUNDLES:
+        parts = []
+        for source in sources:
+            f = open(os.path.join(htdocs_dir, source), 'rb')
+            try:
+                parts.append(f.read())
+            finally:
+                f.close()
+        if name.endswith('.js'):
+            # Sources may lack the final semicolon
+            content = minify_js(';\n'.join(parts))
+        else:
+            content = minify_css('\n'.join(parts))
+
+        filename = hashed_name(name, content)
+        # Drop bundles of previous builds
+        base, ext = os.path.splitext(name)
+        stale = re.compile(r'%s\.[0-9a-f]{10}%s$' % (re.escape(base), re.escape(ext)))
+        for existing in os.listdir(htdocs_dir):
+            if stale.match(existing) and existing != filename:
+                os.remove(os.path.join(htdocs_dir, existing))
+
+        f = open(os.path.join(htdocs_dir, filename), 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        manifest[name] = filename
+
+    f = open(os.path.join(htdocs_dir, MANIFEST), 'w')
+    try:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    return manifest
+
+def load_manifest(htdocs_dir):
+    '''Manifest of the built bundles, empty if they are not built.'''
+    try:
+        f = open(os.path.join(htdocs_dir, MANIFEST))
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    finally:
+        f.close()
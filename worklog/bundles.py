@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import re
+
+from pkg_resources import resource_filename
+
+from trac.core import *
+from trac.web.api import IRequestFilter
+from trac.web.chrome import add_script, add_stylesheet
+
+from assets import BUNDLES, load_manifest
+
+
+
+class WorkLogBundles(Component):
+    '''Adds the static file bundles of the plugin to pages.
+
+    Built bundles have a content hash in their names, so they are
+    served with far-future cache headers. Without a build (e.g. in a
+    source checkout) the source files of a bundle are added instead.'''
+
+    implements(IRequestFilter)
+
+    # One year
+    max_age = 31536000
+
+    def __init__(self):
+        self.manifest = load_manifest(resource_filename(__name__, 'htdocs'))
+        self._hashed = set(self.manifest.values())
+
+    def get_bundle_files(self, name):
+        '''Return chrome paths of the files making up bundle `name`.'''
+        filename = self.manifest.get(name)
+        if filename:
+            return ['worklog/' + filename]
+        return ['worklog/' + filename for filename in dict(BUNDLES)[name]]
+
+    def add_bundle(self, req, name):
+        add = name.endswith('.js') and add_script or add_stylesheet
+        for filename in self.get_bundle_files(name):
+            add(req, filename)
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        match = re.match(r'/chrome/worklog/([^/]+)$', req.path_info)
+        if match and match.group(1) in self._hashed:
+            req.send_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
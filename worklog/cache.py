@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import RLock
+
+
+
+class LRUCache(object):
+    '''Thread-safe mapping with bounded size and least recently used
+    eviction. Counts hits and misses of `get`.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = max(int(maxsize), 1)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses}
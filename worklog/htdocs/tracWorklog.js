@@ -1,40 +1,112 @@
 /*
  * Work log plugin JavaScript code.
  *
- * This assumes that jQuery, jqModal and jCalendar are all loaded.
+ * The ticket page only has a placeholder for the work log box. Its
+ * state is fetched from the status URL of the placeholder; jqModal, the
+ * datepicker and timeEntry are loaded when the stop popup is opened.
  */
 
 var tracWorklog = {
-  
+
+  status: null,
+
+  init: function() {
+    var box = $('#worklogInfo');
+    if (!box.length)
+      return;
+    $.ajax({url: box.attr('data-status'), dataType: 'json',
+            success: function(status) { tracWorklog.render(box, status); },
+            error: function() { box.find('.loading').text('Work log state is not available.'); }});
+  },
+
+  render: function(box, status) {
+    tracWorklog.status = status;
+    box.find('.loading').remove();
+
+    if (status.action) {
+      var label = status.action == 'stop' ? 'Stop Work' : 'Start Work';
+      var form = $('<form id="worklogTicketForm" method="post" class="inlinebuttons"></form>')
+        .attr('action', status.worklog_href)
+        .submit(tracWorklog[status.action]);
+      $.each({__FORM_TOKEN: status.form_token, source_url: status.ticket_href,
+              ticket: status.ticket}, function(name, value) {
+        form.append($('<input type="hidden" />').attr('name', name).val(value));
+      });
+      form.append($('<input type="submit" />').attr('name', status.action + 'work').val(label));
+      box.append(form);
+    }
+
+    var list = $('<ul></ul>');
+    $.each(status.items, function(i, item) {
+      list.append($('<li></li>').html(item));
+    });
+    box.append(list);
+  },
+
+  loadAssets: function(done) {
+    var status = tracWorklog.status;
+    if (tracWorklog.assetsLoaded)
+      return done();
+    $.each(status.stylesheets, function(i, href) {
+      $('head').append($('<link rel="stylesheet" type="text/css" />').attr('href', href));
+    });
+    // Scripts depend on the previous ones, so they are loaded in order
+    var next = function(i) {
+      if (i == status.scripts.length) {
+        tracWorklog.assetsLoaded = true;
+        return done();
+      }
+      $.ajax({url: status.scripts[i], dataType: 'script', cache: true,
+              success: function() { next(i + 1); }});
+    };
+    next(0);
+  },
+
   start: function() { return true; },
+
   stop: function() {
+    tracWorklog.loadAssets(function() {
+      if ($('#worklogPopup').length)
+        return tracWorklog.showStop();
+      $.ajax({url: tracWorklog.status.stop_href, data: {fragment: 1}, dataType: 'html',
+              success: function(html) {
+                $('body').append($('<div></div>').html(html).find('#worklogPopup'));
+                tracWorklog.showStop();
+              }});
+    });
+    return false;
+  },
+
+  showStop: function() {
     var mynow = new Date();
     var change_handler = function()
     {
       var chosen_date = $('#worklogStopDate').datepicker('getDate');
       var chosen_time = $('#worklogStopTime').timeEntry('getTime');
-      
+
       var chosen = new Date();
       chosen.setTime(chosen_date.getTime() + (((chosen_time.getHours() * 60) + chosen_time.getMinutes()) * 60) * 1000);
-      
+
       $('#worklogSubmit')[0].disabled = (chosen > (new Date()));
       $('#worklogStoptime')[0].value = (chosen.getTime() / 1000);
     };
-    
+
     $('#worklogStopDate').datepicker({onSelect: change_handler,
                                     maxDate: new Date()});
     $('#worklogPopup').jqm({modal: true}).jqmShow();
-    
+
     try
     {
       $('#worklogStopTime').timeEntry({show24Hours: true, spinnerImage: ''});
       $('#worklogStopTime').timeEntry('setTime', mynow);
       $('#worklogStopTime').bind('change', change_handler);
     }
-    catch (er) 
+    catch (er)
     {
       alert(er);
     }
     return false;
   }
 };
+
+$(document).ready(tracWorklog.init);
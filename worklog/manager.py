@@ -1,18 +1,140 @@
 # -*- coding: utf-8 -*-
 from time import time
+from threading import local
 
-from trac.core import Component
+from trac.core import Component, implements
 from trac.config import Option, BoolOption, IntOption, ListOption
-from trac.ticket.notification import TicketNotifyEmail
 from trac.ticket import Ticket
 from trac.util.datefmt import pretty_timedelta, format_datetime, to_datetime
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
 
 from trac.project.api import ProjectManagement
 
+from cache import LRUCache
+from stats import counting_cursor, instrumented
+from notification import WorkLogNotifier
+from util import integrity_errors
+
+
+
+def format_log_cursor(entry):
+    '''Return paging cursor pointing at the work log `entry`.'''
+    return '%s:%s:%s' % (entry['lastchange'], entry['ticket'], entry['user'])
+
+def parse_log_cursor(text):
+    '''Parse cursor made by `format_log_cursor`.
+    Return (lastchange, worker, ticket), raise ValueError if malformed.'''
+    lastchange, ticket, worker = text.split(':', 2)
+    return int(lastchange), worker, int(ticket)
+
+def day_buckets(starttime, endtime):
+    '''Split [starttime, endtime) UNIX timestamps into UTC days.
+    Yield (day start timestamp, seconds).'''
+    day = starttime - starttime % 86400
+    while day < endtime:
+        next_day = day + 86400
+        yield day, min(endtime, next_day) - max(starttime, day)
+        day = next_day
+
+
+class WorkLogSettings(object):
+    '''Snapshot of the worklog options of a syllabus, so hot paths read
+    plain attributes instead of resolving syllabus options every time.'''
+
+    options = ('comment', 'autostop', 'autoreassignaccept',
+               'autoreassignaccept_status', 'autoreassignaccept_resolution',
+               'autostopstart', 'work_statuses', 'timingandestimation',
+               'trachoursplugin', 'roundup', 'max_session')
+
+    def __init__(self, mgr, syllabus_id, stamp):
+        self.syllabus_id = syllabus_id
+        self.stamp = stamp
+        for name in self.options:
+            setattr(self, name, getattr(mgr, name).syllabus(syllabus_id))
+        config = mgr.configs.syllabus(syllabus_id)
+        self.hours_field = config.get('ticket-custom', 'hours')
+        self.totalhours_field = config.get('ticket-custom', 'totalhours')
+
+
+class WorkLogState(object):
+    '''Worklog state of a ticket as seen by a user.
+
+    Holds everything the ticket page needs (syllabus, user's active task,
+    who is working on the ticket), so it is fetched once per request.'''
+
+    def __init__(self, mgr, username, ticket, syllabus_id=None):
+        self.username = username
+        self.ticket = ticket
+        if syllabus_id is None:
+            syllabus_id = mgr.pm.get_project_syllabus(ticket.pid)
+        self.syllabus_id = syllabus_id
+        if username != 'anonymous':
+            self.active_task = mgr.get_active_task(username, ticket.pid)
+        else:
+            self.active_task = None
+        self.who, self.since = mgr.who_is_working_on(ticket.id, ticket.pid)
+
+
+class WorkLogEntry(object):
+    '''Work log row holding raw UNIX timestamps (`start`, `end` is 0 for
+    an open session). Display values (`starttime`, `endtime` datetimes,
+    `delta` text, `duration` seconds) are computed when accessed.
+
+    Fields are readable as items too (`entry['user']`), like the dicts
+    work log entries used to be.'''
+
+    __slots__ = ('user', 'start', 'end', 'ticket', 'summary', 'status',
+                 'comment', 'lastchange')
+
+    def __init__(self, user, start, end, ticket, summary, status, comment, lastchange):
+        self.user = user
+        self.start = start
+        self.end = end
+        self.ticket = ticket
+        self.summary = summary
+        self.status = status
+        self.comment = comment
+        self.lastchange = lastchange
+
+    @property
+    def starttime(self):
+        return to_datetime(self.start)
+
+    @property
+    def endtime(self):
+        return self.end and to_datetime(self.end)
+
+    @property
+    def duration(self):
+        '''Seconds worked, until now for an open session.'''
+        return (self.end or int(time())) - self.start
+
+    @property
+    def delta(self):
+        started = self.starttime
+        if self.end:
+            finished = self.endtime
+            return 'Worked for %s (between %s and %s)' % (
+                    pretty_timedelta(started, finished),
+                    format_datetime(started), format_datetime(finished))
+        return 'Started %s ago (%s)' % (pretty_timedelta(started),
+                                        format_datetime(started))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
 
 
 class WorkLogManager(Component):
 
+    implements(IRequestFilter)
+
     comment = BoolOption('worklog', 'comment', False,
            '''Automatically add a comment when you stop work on a ticket?''', switcher=True)
     autostop = BoolOption('worklog', 'autostop', False,
@@ -40,14 +162,148 @@ class WorkLogManager(Component):
     roundup = IntOption('worklog', 'roundup', 1,
            '''Automatically reassign and accept (if necessary) when starting work?''', switcher=True)
 
+    max_session = IntOption('worklog', 'max_session', 0,
+           '''Maximum length of a work session in hours, longer sessions are
+           stopped automatically (0 - no limit).''', switcher=True)
+
+    cache_size = IntOption('worklog', 'cache_size', 100,
+           '''Maximum number of projects whose open work sessions are cached in memory.''')
+
     def __init__(self):
         self.pm = ProjectManagement(self.env)
+        self.notifier = WorkLogNotifier(self.env)
+        self.active_cache = LRUCache(self.cache_size)
+        self._settings = {}
+        # Sessions generations committed by this process, {pid: generation}
+        self._generations = {}
+        self._local = local()
+        self._integrity_errors = integrity_errors(self.env)
 
-    def can_work_on(self, username, ticket, syllabus_id=None):
+    # Settings
+
+    def _settings_stamp(self, syllabus_id):
+        return (getattr(self.config, '_lastmtime', None),
+                getattr(self.configs.syllabus(syllabus_id), '_lastmtime', None))
+
+    def get_settings(self, syllabus_id):
+        '''Return `WorkLogSettings` of the syllabus, rebuilt only when
+        the configuration has changed.'''
+        stamp = self._settings_stamp(syllabus_id)
+        settings = self._settings.get(syllabus_id)
+        if settings is None or settings.stamp != stamp:
+            settings = WorkLogSettings(self, syllabus_id, stamp)
+            self._settings[syllabus_id] = settings
+        return settings
+
+    def reset_settings(self):
+        '''Forget settings snapshots (e.g. once the configuration is saved).'''
+        self._settings = {}
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        # Check the sessions generation of a project at most once per request
+        self._local.checked = set()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Active sessions cache
+
+    def _get_generation(self, pid):
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        cursor.execute('SELECT generation FROM work_log_generation WHERE project_id=%s', (pid,))
+        row = cursor.fetchone()
+        return row and row[0] or 0
+
+    def _bump_generation(self, db, pid):
+        '''Mark open sessions of the project changed, so other processes
+        reload them. Return the new generation, to be passed to
+        `_generations_committed` once the transaction is committed.'''
+        cursor = counting_cursor(db)
+        cursor.execute('UPDATE work_log_generation SET generation=generation+1 '
+                       'WHERE project_id=%s RETURNING generation', (pid,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        # First change in the project, the row may be created concurrently
+        cursor.execute('SAVEPOINT worklog_generation')
+        try:
+            cursor.execute('INSERT INTO work_log_generation (project_id, generation) '
+                           'VALUES (%s, %s)', (pid, 1))
+        except self._integrity_errors:
+            cursor.execute('ROLLBACK TO SAVEPOINT worklog_generation')
+            return self._bump_generation(db, pid)
+        cursor.execute('RELEASE SAVEPOINT worklog_generation')
+        return 1
+
+    def _generations_committed(self, generations):
+        '''Remember generations ({pid: generation}) bumped by a committed
+        transaction, so the sessions of these projects are reloaded
+        without asking the database for the generation.'''
+        self._generations.update(generations)
+
+    def _get_active_sessions(self, pid):
+        '''Return open sessions of the project as a dict with
+        `tickets` ({ticket: (worker, starttime)}) and
+        `workers` ({worker: task dict}) items.'''
+        # Outside of requests (e.g. the reaper thread) always check
+        checked = getattr(self._local, 'checked', None)
+        cached = self.active_cache.get(pid)
+        if cached is not None and checked is not None and pid in checked:
+            return cached[1]
+
+        generation = None
+        if cached is None:
+            generation = self._generations.pop(pid, None)
+        if generation is None:
+            # Read before the sessions, so a change committed meanwhile
+            # makes the next check reload them
+            generation = self._get_generation(pid)
+        if checked is not None:
+            checked.add(pid)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        cursor.execute('''
+            SELECT wl.worker, wl.ticket, t.summary, wl.lastchange, wl.starttime, wl.endtime, wl.comment
+            FROM work_log wl
+            JOIN ticket t ON wl.ticket=t.id AND t.project_id=%s
+            WHERE wl.endtime=0
+            ''', (pid,))
+        sessions = {'tickets': {}, 'workers': {}}
+        for user,ticket,summary,lastchange,starttime,endtime,comment in cursor:
+            sessions['tickets'][ticket] = (user, starttime)
+            sessions['workers'][user] = {'user': user,
+                                         'ticket': ticket,
+                                         'summary': summary,
+                                         'lastchange': lastchange,
+                                         'starttime': starttime,
+                                         'endtime': endtime,
+                                         'comment': comment}
+        self.active_cache.set(pid, (generation, sessions))
+        return sessions
+
+    def _invalidate_active(self, pid):
+        self.active_cache.pop(pid)
+
+    @instrumented
+    def get_state(self, username, ticket, syllabus_id=None):
+        '''Return `WorkLogState` of `ticket` for `username`.'''
+        return WorkLogState(self, username, ticket, syllabus_id)
+
+    @instrumented
+    def can_work_on(self, username, ticket, syllabus_id=None, state=None):
         '''Check if username can start working on given ticket.
         Return (<bool result>, <msg on False>).
 
-        `ticket` - Ticket instance.'''
+        `ticket` - Ticket instance.
+        `state` - optional `WorkLogState` of this ticket for `username`,
+                  saves the lookups when already known.'''
         # Need to check several things.
         # 1. Is ticket status allow to work on it?
         # 2. Is some other user working on this ticket?
@@ -56,8 +312,11 @@ class WorkLogManager(Component):
         # 4. a) Is the autoreassignaccept setting true? or
         #    b) Is the ticket assigned to the user?
 
-        if syllabus_id is None:
+        if state is not None:
+            syllabus_id = state.syllabus_id
+        elif syllabus_id is None:
             syllabus_id = self.pm.get_project_syllabus(ticket.pid)
+        settings = self.get_settings(syllabus_id)
         msg = None
 
         # Are you logged in?
@@ -65,11 +324,14 @@ class WorkLogManager(Component):
             return False, 'You need to be logged in to work on tickets.'
 
         # Check ticket status
-        if ticket['status'] not in self.work_statuses.syllabus(syllabus_id):
+        if ticket['status'] not in settings.work_statuses:
             return False, 'You can not work on ticket with status "%s"' % ticket['status']
 
         # Other user working on it?
-        who, since = self.who_is_working_on(ticket.id)
+        if state is not None:
+            who, since = state.who, state.since
+        else:
+            who, since = self.who_is_working_on(ticket.id)
         if who:
             if who != username:
                 msg = 'Another user (%s) has been working on ticket #%s since %s' % (who, ticket.id, since)
@@ -79,15 +341,18 @@ class WorkLogManager(Component):
 
         # a) Is the autostopstart setting true? or
         # b) Is the user working on a ticket already?
-        if not self.autostopstart.syllabus(syllabus_id):
-            active = self.get_active_task(username, ticket.pid)
+        if not settings.autostopstart:
+            if state is not None:
+                active = state.active_task
+            else:
+                active = self.get_active_task(username, ticket.pid)
             if active:
                 msg = 'You cannot work on ticket #%s as you are currently working on ticket #%s. You have to chill out.' % (ticket.id, active['ticket'])
                 return False, msg
         
         # a) Is the autoreassignaccept setting true? or
         # b) Is the ticket assigned to the user?
-        if not self.autoreassignaccept.syllabus(syllabus_id):
+        if not settings.autoreassignaccept:
             if username != ticket['owner']:
                 msg = 'You cannot work on ticket #%s as you are not the owner. You should speak to %s.' % (ticket.id, ticket['owner'])
                 return False, msg
@@ -95,13 +360,39 @@ class WorkLogManager(Component):
         # If we get here then we know we can start work
         return True, None
 
+    @instrumented
     def save_ticket(self, tkt, who, msg, when):
+        notify = []
+
+        @self.env.with_transaction()
+        def do_save(db):
+            self._save_ticket(tkt, who, msg, when, notify, db)
+        self._send_notifications(notify)
+
+    def _save_ticket(self, tkt, who, msg, when, notify, db):
+        '''Save ticket changes. The notification is queued to the outbox
+        (async mode) or to `notify` list, to be sent by
+        `_send_notifications` once committed.'''
         when = to_datetime(when)
-        tkt.save_changes(who, msg, when)
-        
-        tn = TicketNotifyEmail(self.env)
-        tn.notify(tkt, newticket=0, modtime=when)
+        tkt.save_changes(who, msg, when, db=db)
+        if self.notifier.async_notify:
+            self.notifier.enqueue(db, tkt, when)
+        notify.append((tkt, when))
+
+    def _send_notifications(self, notify):
+        if not notify:
+            return
+        if self.notifier.async_notify:
+            self.notifier.wakeup()
+            return
+        for tkt, when in notify:
+            try:
+                self.notifier.notify(tkt, when)
+            except Exception, e:
+                self.log.error('Failure sending notification on change to '
+                               'ticket #%s: %s', tkt.id, exception_to_unicode(e))
 
+    @instrumented
     def start_work(self, username, tkt_or_id, when=None):
 
         if isinstance(tkt_or_id, Ticket):
@@ -116,46 +407,184 @@ class WorkLogManager(Component):
         if when is None:
             when = int(time())
 
-        can, why = self.can_work_on(username, tkt, syllabus_id)
-        if not can:
-            return False, why
+        # The check, all ticket updates and the work log change are done in
+        # one transaction, notifications are sent once it is committed.
+        # Concurrent starts are finally refused by the unique indexes on
+        # open sessions (per ticket and per project worker).
+        rv = []
+        notify = []
+        generations = {}
+
+        try:
+            @self.env.with_transaction()
+            def do_start(db):
+                # Check against the database state, not the cached one
+                self._invalidate_active(tkt.pid)
+                rv.extend(self.can_work_on(username, tkt, syllabus_id))
+                if rv[0]:
+                    self._start_work(db, username, tkt, syllabus_id, when, notify)
+                    generations[tkt.pid] = self._bump_generation(db, tkt.pid)
+            self._generations_committed(generations)
+        except self._integrity_errors, e:
+            return False, self._concurrent_start(username, tkt_id, e)
+        finally:
+            self._invalidate_active(tkt.pid)
+        if not rv[0]:
+            return tuple(rv)
+        self._send_notifications(notify)
+
+        return True, None
+
+    def _concurrent_start(self, username, tkt_id, e):
+        self.log.info('Concurrent start of work on ticket #%s by %s refused: %s',
+                      tkt_id, username, exception_to_unicode(e))
+        return 'Work on ticket #%s or another ticket of yours has just been ' \
+               'started concurrently. Please reload the page.' % (tkt_id,)
 
+    def _start_work(self, db, username, tkt, syllabus_id, when, notify):
+        '''Start work, the caller bumps the sessions generation as the
+        last statement of the transaction. The generation row is locked
+        until the commit, so taking it before the work_log INSERT could
+        deadlock with a concurrent start waiting on that lock.'''
+        tkt_id = tkt.id
+        settings = self.get_settings(syllabus_id)
         # We could just horse all the fields of the ticket to the right values
         # bit it seems more correct to follow the in-build state-machine for
         # ticket modification.
 
         if username != tkt['owner']:
             tkt['owner'] = username
-            tkt['status'] = self.autoreassignaccept_status.syllabus(syllabus_id)
-            tkt['resolution'] = self.autoreassignaccept_resolution.syllabus(syllabus_id)
-            self.save_ticket(tkt, username, 'Automatically reassigning in order to start work.', when)
-
-            # Reinitialise for next test
-            tkt = Ticket(self.env, tkt_id)
+            tkt['status'] = settings.autoreassignaccept_status
+            tkt['resolution'] = settings.autoreassignaccept_resolution
+            self._save_ticket(tkt, username, 'Automatically reassigning in order to start work.',
+                              when, notify, db)
 
         # Stop work on another ticket
         # depending on config options
-        if self.autostopstart.syllabus(syllabus_id):
+        if settings.autostopstart:
             # Don't care if this fails, as with these arguments the only failure
             # point is if there is no active task... which is the desired scenario
-            self.stop_work(username, tkt.pid, when-1,
-                           'Stopping work on this ticket to start work on #%s.' % (tkt_id))
- 
-        @self.env.with_transaction()
-        def do_log(db):
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO work_log (worker, ticket, lastchange, starttime, endtime) '
-                           'VALUES (%s, %s, %s, %s, %s)',
-                           (username, tkt_id, when, when, 0))
+            self._stop_work(db, username, tkt.pid, when-1,
+                            'Stopping work on this ticket to start work on #%s.' % (tkt_id),
+                            notify)
 
-        return True, None
+        cursor = counting_cursor(db)
+        cursor.execute('INSERT INTO work_log (worker, ticket, project_id, lastchange, starttime, endtime) '
+                       'VALUES (%s, %s, %s, %s, %s, %s)',
+                       (username, tkt_id, tkt.pid, when, when, 0))
+        # The new session is the latest one of the worker, stopping it
+        # later changes the same row, so only starts update this table
+        cursor.execute('UPDATE work_log_latest SET ticket=%s, starttime=%s '
+                       'WHERE project_id=%s AND worker=%s',
+                       (tkt_id, when, tkt.pid, username))
+        if cursor.rowcount == 0:
+            cursor.execute('INSERT INTO work_log_latest (project_id, worker, ticket, starttime) '
+                           'VALUES (%s, %s, %s, %s)',
+                           (tkt.pid, username, tkt_id, when))
+
+    @instrumented
+    def start_work_many(self, username, tickets, when=None):
+        '''Start work on several tickets (of different projects) in a
+        single transaction. Each start is done in a savepoint, so one
+        refused by a concurrent start does not undo the others.
+        Notifications are sent once the transaction is committed.
+        Return list of (<bool result>, <msg on False>).'''
+        if when is None:
+            when = int(time())
+        rv = []
+        notify = []
+        pids = set()
+        started = set()
+        generations = {}
+
+        try:
+            @self.env.with_transaction()
+            def do_start(db):
+                cursor = counting_cursor(db)
+                for tkt in tickets:
+                    if not isinstance(tkt, Ticket):
+                        tkt = Ticket(self.env, int(tkt), db=db)
+                    pids.add(tkt.pid)
+                    syllabus_id = self.pm.get_project_syllabus(tkt.pid)
+                    # Check against the database state, including the
+                    # starts done earlier in this transaction
+                    self._invalidate_active(tkt.pid)
+                    res = self.can_work_on(username, tkt, syllabus_id)
+                    if not res[0]:
+                        rv.append(res)
+                        continue
+                    tkt_notify = []
+                    cursor.execute('SAVEPOINT worklog_start')
+                    try:
+                        self._start_work(db, username, tkt, syllabus_id, when, tkt_notify)
+                    except self._integrity_errors, e:
+                        cursor.execute('ROLLBACK TO SAVEPOINT worklog_start')
+                        rv.append((False, self._concurrent_start(username, tkt.id, e)))
+                    else:
+                        cursor.execute('RELEASE SAVEPOINT worklog_start')
+                        notify.extend(tkt_notify)
+                        started.add(tkt.pid)
+                        rv.append((True, None))
+                for pid in started:
+                    generations[pid] = self._bump_generation(db, pid)
+            self._generations_committed(generations)
+        finally:
+            for pid in pids:
+                self._invalidate_active(pid)
+        self._send_notifications(notify)
+        return rv
+
+    @instrumented
+    def stop_work_many(self, username, pids, stoptime=None, comment=None):
+        '''Stop active user tasks in several projects in a single
+        transaction, a database error fails the whole batch.
+        Notifications are sent once the transaction is committed.
+        Return list of (<bool result>, <msg on False>).'''
+        rv = []
+        notify = []
+        generations = {}
+
+        try:
+            @self.env.with_transaction()
+            def do_stop(db):
+                for pid in pids:
+                    rv.append(self._stop_work(db, username, pid, stoptime, comment, notify))
+                for pid, (res, msg) in zip(pids, rv):
+                    if res:
+                        generations[pid] = self._bump_generation(db, pid)
+            self._generations_committed(generations)
+        finally:
+            for pid in pids:
+                self._invalidate_active(pid)
+        self._send_notifications(notify)
+        return rv
 
+    @instrumented
     def stop_work(self, username, pid, stoptime=None, comment=None):
         '''Stop active user task in specified project.
 
         `stoptime` - UNIX timestamp
         '''
+        rv = []
+        notify = []
+        generations = {}
+
+        try:
+            @self.env.with_transaction()
+            def do_stop(db):
+                rv.extend(self._stop_work(db, username, pid, stoptime, comment, notify))
+                if rv[0]:
+                    generations[pid] = self._bump_generation(db, pid)
+            self._generations_committed(generations)
+        finally:
+            self._invalidate_active(pid)
+        self._send_notifications(notify)
 
+        return tuple(rv)
+
+    def _stop_work(self, db, username, pid, stoptime, comment, notify):
+        '''Stop work, the caller bumps the sessions generation (see
+        `_start_work`).'''
         active = self.get_active_task(username, pid)
         if not active:
             return False, 'There are no active tasks.'
@@ -171,25 +600,29 @@ class WorkLogManager(Component):
 
         tkt_id = active['ticket']
 
-        @self.env.with_transaction()
-        def do_log(db):
-            cursor = db.cursor()
-            cursor.execute('UPDATE work_log '
-                           'SET endtime=%s, lastchange=%s, comment=%s '
-                           'WHERE worker=%s AND ticket=%s AND lastchange=%s AND endtime=0',
-                           (stoptime, stoptime, comment,
-                            username, tkt_id, active['lastchange']))
+        cursor = counting_cursor(db)
+        # lastchange is the real time of change (stoptime may be
+        # backdated), so "changes since" readers do not miss it
+        cursor.execute('UPDATE work_log '
+                       'SET endtime=%s, lastchange=%s, comment=%s '
+                       'WHERE worker=%s AND ticket=%s AND starttime=%s AND endtime=0',
+                       (stoptime, now, comment,
+                        username, tkt_id, active['starttime']))
+        if cursor.rowcount != 1:
+            # Stopped concurrently
+            return False, 'There are no active tasks.'
+        self._update_rollup(db, pid, username, tkt_id, active['starttime'], stoptime)
 
-        syllabus_id = self.pm.get_project_syllabus(pid)
+        settings = self.get_settings(self.pm.get_project_syllabus(pid))
 
-        plugtne = self.timingandestimation.syllabus(syllabus_id) and self.configs.syllabus(syllabus_id).get('ticket-custom', 'hours')
-        plughrs = self.trachoursplugin.syllabus(syllabus_id) and self.configs.syllabus(syllabus_id).get('ticket-custom', 'totalhours')
+        plugtne = settings.timingandestimation and settings.hours_field
+        plughrs = settings.trachoursplugin and settings.totalhours_field
 
         message = ''
         hours = 0.0
 
         if plugtne or plughrs:
-            round_delta = self.roundup.syllabus(syllabus_id) or 1
+            round_delta = settings.roundup or 1
             # Get the delta in minutes
             delta = ( int(stoptime) - int(active['starttime']) ) / 60.0
             # Round up if needed
@@ -198,7 +631,7 @@ class WorkLogManager(Component):
 
         if plughrs:
             message = 'Hours recorded automatically by the worklog plugin. %s hours' % hours
-        elif self.comment.syllabus(syllabus_id) or comment:
+        elif settings.comment or comment:
             started = to_datetime(active['starttime'])
             finished = to_datetime(stoptime)
             message = '%s worked on this ticket for %s between %s and %s.' % (
@@ -207,58 +640,104 @@ class WorkLogManager(Component):
         if comment:
             message += "\n\n" + comment
 
-        if plugtne or plughrs:
-            if not message:
-                message = 'Hours recorded automatically by the worklog plugin.'
-
-            tckt = Ticket(self.env, tkt_id)
+        if (plugtne or plughrs) and not message:
+            message = 'Hours recorded automatically by the worklog plugin.'
 
+        # Hours and comment go to the ticket as a single change
+        if message:
+            tckt = Ticket(self.env, tkt_id, db=db)
             if plugtne:
                 tckt['hours'] = hours
-            self.save_ticket(tckt, username, message, stoptime)
-            message = None
-
-        if message:
-            tckt = Ticket(self.env, active['ticket'])
-            self.save_ticket(tckt, username, message, stoptime)
+            self._save_ticket(tckt, username, message, stoptime, notify, db)
 
         return True, None
 
-    def who_is_working_on(self, tkt_id):
-        '''Return (who, since) are working on ticket'''
+    @instrumented
+    def stop_stale_work(self, now=None):
+        '''Stop work sessions longer than `max_session` hours of their
+        syllabus, recording exactly `max_session` hours of work.
+        Return the number of stopped sessions.'''
+        if now is None:
+            now = int(time())
         db = self.env.get_read_db()
-        cursor = db.cursor()
+        cursor = counting_cursor(db)
+        cursor.execute('SELECT DISTINCT project_id FROM work_log WHERE endtime=0')
+        by_syllabus = {}
+        for pid, in cursor.fetchall():
+            by_syllabus.setdefault(self.pm.get_project_syllabus(pid), []).append(pid)
+
+        stopped = [0]
+        generations = {}
+        for syllabus_id, pids in by_syllabus.iteritems():
+            hours = self.get_settings(syllabus_id).max_session
+            if not hours or hours <= 0:
+                continue
+            length = hours * 3600
+            comment = 'Work stopped automatically after %s hours.' % hours
+            in_pids = ','.join(['%s'] * len(pids))
+
+            @self.env.with_transaction()
+            def do_stop(db):
+                cursor = counting_cursor(db)
+                # Only the rows closed by this statement are returned, so
+                # a concurrent reaper can not make them rolled up twice
+                cursor.execute('UPDATE work_log '
+                               'SET endtime=starttime+%%s, lastchange=%%s, comment=%%s '
+                               'WHERE endtime=0 AND starttime<%%s AND project_id IN (%s) '
+                               'RETURNING project_id, worker, ticket, starttime, endtime' % in_pids,
+                               [length, now, comment, now - length] + pids)
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                stopped[0] += len(rows)
+                for pid, worker, ticket, starttime, endtime in rows:
+                    self._update_rollup(db, pid, worker, ticket, starttime, endtime)
+                for pid in set(row[0] for row in rows):
+                    generations[pid] = self._bump_generation(db, pid)
+            self._generations_committed(generations)
+            for pid in pids:
+                self._invalidate_active(pid)
+        if stopped[0]:
+            self.log.info('Stopped %s work sessions longer than allowed', stopped[0])
+        return stopped[0]
+
+    @instrumented
+    def who_is_working_on(self, tkt_id, pid=None):
+        '''Return (who, since) are working on ticket.
+
+        `pid` - project of the ticket, allows to answer from the active
+                sessions cache.'''
+        if pid is not None:
+            return self._get_active_sessions(pid)['tickets'].get(int(tkt_id), (None, None))
+
+        # Served by the partial index on open sessions (work_log_open_ticket_idx)
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
         cursor.execute('SELECT worker,starttime FROM work_log WHERE ticket=%s AND endtime=0', (tkt_id,))
         res = cursor.fetchone()
         if res:
             return res
         return None,None
 
+    @instrumented
+    def who_is_working_on_many(self, tkt_ids):
+        '''Return {ticket: (who, since)} for tickets being worked on
+        among `tkt_ids`.'''
+        tkt_ids = [int(tkt_id) for tkt_id in tkt_ids]
+        if not tkt_ids:
+            return {}
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        cursor.execute('SELECT ticket,worker,starttime FROM work_log '
+                       'WHERE endtime=0 AND ticket IN (%s)' % ','.join(['%s'] * len(tkt_ids)),
+                       tkt_ids)
+        return dict((ticket, (worker, starttime)) for ticket, worker, starttime in cursor)
+
     def who_last_worked_on(self, tkt_id):
         raise NotImplementedError
 
-    def get_latest_task(self, username, pid):
-        if username == 'anonymous':
-            return None
-
-        db = self.env.get_read_db()
-        cursor = db.cursor()
-
+    def _get_task(self, cursor):
         task = {}
-        cursor.execute('''
-            SELECT worker, ticket, summary, lastchange, starttime, endtime, comment
-            FROM (
-                SELECT wl.worker, wl.ticket, t.summary, wl.lastchange, wl.starttime, wl.endtime, wl.comment,
-                MAX(wl.lastchange) OVER (PARTITION BY wl.worker) latest
-                FROM work_log wl
-                JOIN ticket t ON wl.ticket=t.id AND t.project_id=%s
-                WHERE wl.worker=%s
-            ) wll
-            WHERE lastchange=latest
-            ORDER BY endtime
-            LIMIT 1
-            ''', (pid, username))
-
         for user,ticket,summary,lastchange,starttime,endtime,comment in cursor:
             task['user'] = user
             task['ticket'] = ticket
@@ -268,73 +747,353 @@ class WorkLogManager(Component):
             task['endtime'] = endtime
             task['comment'] = comment
         return task
-    
-    def get_active_task(self, username, pid):
-        task = self.get_latest_task(username, pid)
-        if not task:
-            return None
-        if not task.has_key('endtime'):
+
+    @instrumented
+    def get_latest_task(self, username, pid):
+        if username == 'anonymous':
             return None
 
-        if task['endtime'] > 0:
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+
+        cursor.execute('''
+            SELECT wl.worker, wl.ticket, t.summary, wl.lastchange, wl.starttime, wl.endtime, wl.comment
+            FROM work_log_latest l
+            JOIN work_log wl ON wl.worker=l.worker AND wl.starttime=l.starttime AND wl.ticket=l.ticket
+            JOIN ticket t ON wl.ticket=t.id
+            WHERE l.project_id=%s AND l.worker=%s
+            ''', (pid, username))
+        return self._get_task(cursor)
+
+    @instrumented
+    def get_active_task(self, username, pid):
+        if username == 'anonymous':
             return None
 
-        return task
+        task = self._get_active_sessions(pid)['workers'].get(username)
+        return task and dict(task)
+
+    def _filter_sql(self, filters):
+        '''Return (conditions, args) restricting work log rows (`wl`) joined
+        with tickets (`t`) by `filters` dict items:
+         * `since` - UNIX timestamp, rows changed after it
+         * `from`, `to` - UNIX timestamps, sessions started in [from, to)
+         * `users`, `tickets`, `milestones`, `components` - lists of values
+        '''
+        where = []
+        args = []
+        if not filters:
+            return where, args
+        if filters.get('since') is not None:
+            where.append('wl.lastchange>%s')
+            args.append(filters['since'])
+        if filters.get('from') is not None:
+            where.append('wl.starttime>=%s')
+            args.append(filters['from'])
+        if filters.get('to') is not None:
+            where.append('wl.starttime<%s')
+            args.append(filters['to'])
+        for name, column in (('users', 'wl.worker'),
+                             ('tickets', 'wl.ticket'),
+                             ('milestones', 't.milestone'),
+                             ('components', 't.component')):
+            values = filters.get(name)
+            if values:
+                where.append('%s IN (%s)' % (column, ','.join(['%s'] * len(values))))
+                args.extend(values)
+        return where, args
+
+    def _execute_work_log(self, cursor, pid, username=None, limit=None,
+                          before=None, after=None, filters=None, ascending=False):
+        where, args = self._filter_sql(filters)
+        where.insert(0, 't.project_id=%s')
+        args.insert(0, pid)
+        if username is not None:
+            where.append('wl.worker=%s')
+            args.append(username)
+        order = ascending and 'ASC' or 'DESC'
+        if before is not None:
+            where.append('(wl.lastchange, wl.worker, wl.ticket) < (%s, %s, %s)')
+            args.extend(before)
+        elif after is not None:
+            where.append('(wl.lastchange, wl.worker, wl.ticket) > (%s, %s, %s)')
+            args.extend(after)
+            order = 'ASC'
+        sql = ('SELECT wl.worker, wl.starttime, wl.endtime, wl.ticket, t.summary, t.status, wl.comment, wl.lastchange '
+               'FROM work_log wl '
+               'JOIN ticket t ON wl.ticket=t.id '
+               'WHERE %s '
+               'ORDER BY wl.lastchange %s, wl.worker %s, wl.ticket %s'
+               % (' AND '.join(where), order, order, order))
+        if limit:
+            sql += ' LIMIT %s'
+            args.append(limit)
+        cursor.execute(sql, args)
+
+    def iter_work_log(self, pid, username=None, filters=None, batch_size=1000):
+        '''Iterate over raw work log rows of the project (or of `username`
+        only), latest changes first. Rows are fetched in batches of
+        `batch_size` using keyset paging, so memory use stays bounded.
+        `filters` - see `get_work_log`.
+
+        Yield (worker, starttime, endtime, ticket, summary, status, comment, lastchange)
+        tuples with UNIX timestamps.'''
+        db = self.env.get_read_db()
+        before = None
+        while True:
+            cursor = counting_cursor(db)
+            self._execute_work_log(cursor, pid, username, batch_size, before,
+                                   filters=filters)
+            rows = cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            worker, ticket, lastchange = rows[-1][0], rows[-1][3], rows[-1][7]
+            before = (lastchange, worker, ticket)
+
+    @instrumented
+    def get_changes(self, pid, since=0, cursor=None, limit=500):
+        '''Return work log rows of the project changed after `since`
+        (UNIX timestamp) or, if given, after the `cursor` position
+        (made by `format_log_cursor`), oldest change first.
 
-    def get_work_log(self, pid, username=None, mode='all'):
+        Return (entries, cursor, more): at most `limit` dicts with raw
+        UNIX timestamps, the high-water mark cursor to continue from
+        (None if nothing changed after `since`) and whether there are
+        more changes.'''
         db = self.env.get_read_db()
-        cursor = db.cursor()
-        if mode == 'user':
-            assert username is not None
-            cursor.execute('SELECT wl.worker, wl.starttime, wl.endtime, wl.ticket, t.summary, t.status, wl.comment '
-                           'FROM work_log wl '
-                           'JOIN ticket t ON wl.ticket=t.id '
-                           'WHERE t.project_id=%s AND wl.worker=%s '
-                           'ORDER BY wl.lastchange DESC',
-                           (pid, username))
+        db_cursor = counting_cursor(db)
+        if cursor:
+            self._execute_work_log(db_cursor, pid, limit=limit + 1,
+                                   after=parse_log_cursor(cursor))
+        else:
+            cursor = None
+            self._execute_work_log(db_cursor, pid, limit=limit + 1,
+                                   filters={'since': since}, ascending=True)
+        entries = []
+        for user,starttime,endtime,ticket,summary,status,comment,lastchange in db_cursor:
+            entries.append({'user': user,
+                            'ticket': ticket,
+                            'summary': summary,
+                            'status': status,
+                            'comment': comment,
+                            'starttime': starttime,
+                            'endtime': endtime,
+                            'lastchange': lastchange})
+        more = len(entries) > limit
+        del entries[limit:]
+        if entries:
+            cursor = format_log_cursor(entries[-1])
+        return entries, cursor, more
+
+    @instrumented
+    def get_active_tasks(self, usernames, pid):
+        '''Return {username: task} for users among `usernames` having
+        an active task in the project.'''
+        workers = self._get_active_sessions(pid)['workers']
+        return dict((username, dict(workers[username]))
+                    for username in usernames if username in workers)
+
+    @instrumented
+    def get_work_log(self, pid, username=None, mode='all', limit=None,
+                     before=None, after=None, filters=None):
+        '''Return work log entries (`WorkLogEntry` rows) of the project,
+        latest changes first.
+
+        `mode` - 'all', 'user' (entries of `username`) or
+                 'latest' (latest entry of each worker, read from
+                 `work_log_latest` unless filtered by more than users).
+        `limit`, `before`, `after` - keyset paging for 'all' and 'user' modes:
+                 return at most `limit` entries older than `before` or
+                 newer than `after` cursor (see `parse_log_cursor`).
+        `filters` - dict of SQL side filters, see `_filter_sql`.'''
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        # Filters other than by users need the latest of the matching rows
+        history_filters = [name for name, value in (filters or {}).items()
+                           if value and name != 'users']
+        if mode == 'latest' and not history_filters:
+            # One row per worker of the project from work_log_latest
+            where, args = self._filter_sql(filters)
+            where.insert(0, 'l.project_id=%s')
+            args.insert(0, pid)
+            cursor.execute('''
+                SELECT wl.worker, wl.starttime, wl.endtime, wl.ticket, t.summary, t.status, wl.comment, wl.lastchange
+                FROM work_log_latest l
+                JOIN work_log wl ON wl.worker=l.worker AND wl.starttime=l.starttime AND wl.ticket=l.ticket
+                JOIN ticket t ON wl.ticket=t.id
+                WHERE %s
+                ORDER BY wl.lastchange DESC, wl.worker
+               ''' % ' AND '.join(where), args)
         elif mode == 'latest':
+            # Latest of the rows matching the filters
+            where, args = self._filter_sql(filters)
+            args.insert(0, pid)
             cursor.execute('''
-                SELECT worker, starttime, endtime, ticket, summary, status, comment 
+                SELECT worker, starttime, endtime, ticket, summary, status, comment, lastchange
                 FROM (
                     SELECT wl.worker, wl.starttime, wl.endtime, wl.ticket, wl.comment, wl.lastchange,
                     MAX(wl.lastchange) OVER (PARTITION BY wl.worker) latest,
                     t.summary, t.status
                     FROM work_log wl
-                    JOIN ticket t ON wl.ticket=t.id AND project_id=%s
+                    JOIN ticket t ON wl.ticket=t.id AND t.project_id=%%s
+                    %s
                 ) wll
                 WHERE lastchange=latest
                 ORDER BY lastchange DESC, worker
-               ''', (pid,))
+               ''' % (where and 'WHERE ' + ' AND '.join(where) or ''), args)
         else:
-            cursor.execute('SELECT wl.worker, wl.starttime, wl.endtime, wl.ticket, t.summary, t.status, wl.comment '
-                           'FROM work_log wl '
-                           'JOIN ticket t ON wl.ticket=t.id '
-                           'WHERE t.project_id=%s '
-                           'ORDER BY wl.lastchange DESC, wl.worker',
-                           (pid,))
-
-        rv = []
-        for user,starttime,endtime,ticket,summary,status,comment in cursor:
-            started = to_datetime(starttime)
-
-            if endtime != 0:
-                finished = to_datetime(endtime)
-                delta = 'Worked for %s (between %s and %s)' % (
-                         pretty_timedelta(started, finished),
-                         format_datetime(started), format_datetime(finished))
+            if mode == 'user':
+                assert username is not None
             else:
-                finished = 0
-                delta = 'Started %s ago (%s)' % (
-                         pretty_timedelta(started),
-                         format_datetime(started))
-
-            rv.append({'user': user,
-                       'starttime': started,
-                       'endtime': finished,
-                       'delta': delta,
-                       'ticket': ticket,
-                       'summary': summary,
-                       'status': status,
-                       'comment': comment})
+                username = None
+            self._execute_work_log(cursor, pid, username, limit, before, after,
+                                   filters)
+
+        rv = [WorkLogEntry(*row) for row in cursor]
+        if after is not None and mode != 'latest':
+            rv.reverse()
         return rv
-        
\ No newline at end of file
+
+    # Time rollups
+
+    summary_groups = {'user': 'r.worker',
+                      'ticket': 'r.ticket',
+                      'day': 'r.day',
+                      # Weeks start on Monday (1970-01-05 is 345600)
+                      'week': 'r.day - (r.day - 345600) %% 604800'}
+
+    def _update_rollup(self, db, pid, worker, ticket, starttime, endtime):
+        '''Add a finished work session to the per day time rollups.'''
+        cursor = counting_cursor(db)
+        sessions = 1
+        for day, seconds in day_buckets(starttime, endtime):
+            cursor.execute('UPDATE work_log_rollup '
+                           'SET seconds=seconds+%s, sessions=sessions+%s '
+                           'WHERE project_id=%s AND worker=%s AND ticket=%s AND day=%s',
+                           (seconds, sessions, pid, worker, ticket, day))
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO work_log_rollup '
+                               '(project_id, worker, ticket, day, seconds, sessions) '
+                               'VALUES (%s, %s, %s, %s, %s, %s)',
+                               (pid, worker, ticket, day, seconds, sessions))
+            # Session is counted at the day it was started
+            sessions = 0
+
+    @instrumented
+    def rebuild_rollups(self, db=None):
+        '''Recompute time rollups of all projects from the work log.
+        Return the number of rollup rows.'''
+        count = [0]
+
+        @self.env.with_transaction(db)
+        def do_rebuild(db):
+            cursor = counting_cursor(db)
+            cursor.execute('DELETE FROM work_log_rollup')
+
+            buckets = {}
+            def flush():
+                cursor.executemany('INSERT INTO work_log_rollup '
+                                   '(project_id, worker, ticket, day, seconds, sessions) '
+                                   'VALUES (%s, %s, %s, %s, %s, %s)',
+                                   [key + tuple(value) for key, value in buckets.iteritems()])
+                count[0] += len(buckets)
+                buckets.clear()
+
+            read_cursor = counting_cursor(db)
+            read_cursor.execute('SELECT t.project_id, wl.worker, wl.ticket, wl.starttime, wl.endtime '
+                                'FROM work_log wl '
+                                'JOIN ticket t ON wl.ticket=t.id '
+                                'WHERE wl.endtime<>0 '
+                                'ORDER BY t.project_id')
+            last_pid = None
+            for pid, worker, ticket, starttime, endtime in read_cursor:
+                # Keep buckets of a single project in memory only
+                if pid != last_pid and buckets:
+                    flush()
+                last_pid = pid
+                sessions = 1
+                for day, seconds in day_buckets(starttime, endtime):
+                    value = buckets.setdefault((pid, worker, ticket, day), [0, 0])
+                    value[0] += seconds
+                    value[1] += sessions
+                    sessions = 0
+            if buckets:
+                flush()
+
+        return count[0]
+
+    @instrumented
+    def get_summary(self, pid, group='user', filters=None):
+        '''Return time spent in the project read from the rollups, as a list
+        of dicts with `group` (value grouped by), `seconds` and `sessions`,
+        ordered by group value.
+
+        `group` - one of `summary_groups` keys.
+        `filters` - dict with optional `from`, `to` (UNIX timestamps, whole
+                    days are matched), `users` and `tickets` lists.'''
+        column = self.summary_groups[group]
+        where = ['r.project_id=%s']
+        args = [pid]
+        filters = filters or {}
+        if filters.get('from') is not None:
+            where.append('r.day>=%s')
+            args.append(filters['from'] - filters['from'] % 86400)
+        if filters.get('to') is not None:
+            where.append('r.day<%s')
+            args.append(filters['to'])
+        for name, col in (('users', 'r.worker'), ('tickets', 'r.ticket')):
+            values = filters.get(name)
+            if values:
+                where.append('%s IN (%s)' % (col, ','.join(['%s'] * len(values))))
+                args.extend(values)
+
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        cursor.execute('SELECT %s AS grp, SUM(r.seconds), SUM(r.sessions) '
+                       'FROM work_log_rollup r '
+                       'WHERE %s '
+                       'GROUP BY grp '
+                       'ORDER BY grp' % (column, ' AND '.join(where)), args)
+        return [{'group': grp, 'seconds': int(seconds), 'sessions': int(sessions)}
+                for grp, seconds, sessions in cursor]
+
+    # Reports
+
+    report_groups = {'user': 'wl.worker',
+                     'ticket': 'wl.ticket',
+                     'milestone': 't.milestone',
+                     'component': 't.component',
+                     # Weeks start on Monday (1970-01-05 is 345600)
+                     'week': 'wl.starttime - (wl.starttime - 345600) %% 604800'}
+
+    @instrumented
+    def get_report(self, pid, group='user', filters=None, now=None):
+        '''Return time spent in the project computed from the work log, as
+        a list of dicts with `group` (value grouped by), `seconds` and
+        `sessions`, ordered by group value. Unfinished sessions are
+        counted up to `now` (UNIX timestamp, current time by default).
+
+        `group` - one of `report_groups` keys.
+        `filters` - dict of SQL side filters, see `_filter_sql`.'''
+        if now is None:
+            now = int(time())
+        column = self.report_groups[group]
+        where, args = self._filter_sql(filters)
+        where.insert(0, 't.project_id=%s')
+        args.insert(0, pid)
+        args.insert(0, now)
+
+        db = self.env.get_read_db()
+        cursor = counting_cursor(db)
+        cursor.execute('SELECT %s AS grp, '
+                       'SUM(CASE WHEN wl.endtime=0 THEN %%s ELSE wl.endtime END - wl.starttime), '
+                       'COUNT(*) '
+                       'FROM work_log wl '
+                       'JOIN ticket t ON wl.ticket=t.id '
+                       'WHERE %s '
+                       'GROUP BY grp '
+                       'ORDER BY grp' % (column, ' AND '.join(where)), args)
+        return [{'group': grp, 'seconds': int(seconds), 'sessions': int(sessions)}
+                for grp, seconds, sessions in cursor]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from time import time
+
+from trac.core import Component, implements
+from trac.config import BoolOption, IntOption
+from trac.resource import ResourceNotFound
+from trac.ticket import Ticket
+from trac.ticket.notification import TicketNotifyEmail
+from trac.util.datefmt import to_utimestamp, from_utimestamp
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
+
+from util import BackgroundWorker
+
+
+
+class WorkLogNotifier(Component):
+    '''Sends ticket notifications of worklog originated ticket changes.
+
+    Changes are put to the `work_log_notify` outbox table in the same
+    transaction as the ticket change and sent by a background thread,
+    so request handling does not wait for the mail delivery.'''
+
+    implements(IRequestFilter)
+
+    async_notify = BoolOption('worklog', 'async_notify', True,
+           '''Send ticket notifications of worklog changes from a background thread?''')
+    notify_retries = IntOption('worklog', 'notify_retries', 5,
+           '''Number of attempts to send a ticket notification before giving up.''')
+    notify_interval = IntOption('worklog', 'notify_interval', 60,
+           '''Interval (in seconds) between checks of the notification outbox for retries.''')
+
+    # Seconds a sender has to deliver a claimed notification
+    lease = 300
+
+    def __init__(self):
+        self.worker = BackgroundWorker('Worklog notifications', self.send_pending,
+                                       self.notify_interval, self.log)
+
+    def enqueue(self, db, tkt, when):
+        '''Queue notification on `tkt` change made at `when` (datetime).'''
+        cursor = db.cursor()
+        cursor.execute('INSERT INTO work_log_notify (ticket, modtime, attempts, next_attempt) '
+                       'VALUES (%s, %s, %s, %s)',
+                       (tkt.id, to_utimestamp(when), 0, 0))
+
+    def wakeup(self):
+        '''Make the background thread send queued notifications.'''
+        self.worker.wakeup()
+
+    def _get_ticket(self, tkt_id):
+        return Ticket(self.env, tkt_id)
+
+    def notify(self, tkt, when):
+        tn = TicketNotifyEmail(self.env)
+        tn.notify(tkt, newticket=0, modtime=when)
+
+    def send_pending(self):
+        '''Send due notifications of the outbox.'''
+        now = int(time())
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT ticket, modtime, attempts, next_attempt FROM work_log_notify '
+                       'WHERE next_attempt<=%s ORDER BY modtime LIMIT 100', (now,))
+        for tkt_id, modtime, attempts, next_attempt in cursor.fetchall():
+            if self._claim(tkt_id, modtime, next_attempt, now + self.lease):
+                self._send(tkt_id, modtime, attempts)
+
+    def _claim(self, tkt_id, modtime, next_attempt, lease_end):
+        # Other processes may drain the outbox too, only one of them
+        # moves next_attempt forward
+        claimed = [False]
+
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            cursor.execute('UPDATE work_log_notify SET next_attempt=%s '
+                           'WHERE ticket=%s AND modtime=%s AND next_attempt=%s',
+                           (lease_end, tkt_id, modtime, next_attempt))
+            claimed[0] = cursor.rowcount == 1
+        return claimed[0]
+
+    def _send(self, tkt_id, modtime, attempts):
+        error = None
+        try:
+            self.notify(self._get_ticket(tkt_id), from_utimestamp(modtime))
+        except ResourceNotFound:
+            # Ticket was deleted meanwhile
+            pass
+        except Exception, e:
+            error = exception_to_unicode(e)
+
+        @self.env.with_transaction()
+        def do_done(db):
+            cursor = db.cursor()
+            if error is None or attempts + 1 >= self.notify_retries:
+                cursor.execute('DELETE FROM work_log_notify WHERE ticket=%s AND modtime=%s',
+                               (tkt_id, modtime))
+            else:
+                # Retry with exponential backoff
+                cursor.execute('UPDATE work_log_notify '
+                               'SET attempts=%s, next_attempt=%s, error=%s '
+                               'WHERE ticket=%s AND modtime=%s',
+                               (attempts + 1, int(time()) + 60 * 2 ** attempts, error,
+                                tkt_id, modtime))
+        if error is not None:
+            self.log.error('Failure sending notification on change to ticket #%s '
+                           '(attempt %s of %s): %s', tkt_id, attempts + 1,
+                           self.notify_retries, error)
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        # Changes queued before a restart and retries are sent without
+        # waiting for a new worklog change in this process
+        if self.async_notify:
+            self.worker.start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
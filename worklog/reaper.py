@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from trac.core import Component, implements
+from trac.config import IntOption
+from trac.web.api import IRequestFilter
+
+from manager import WorkLogManager
+from util import BackgroundWorker
+
+
+
+class WorkLogReaper(Component):
+    '''Periodically stops work sessions which are longer than the
+    `[worklog] max_session` limit (people do forget to stop work).'''
+
+    implements(IRequestFilter)
+
+    reaper_interval = IntOption('worklog', 'reaper_interval', 600,
+           '''Interval (in seconds) between checks for too long work sessions.''')
+
+    def __init__(self):
+        self.mgr = WorkLogManager(self.env)
+        self.worker = BackgroundWorker('Worklog reaper', self.mgr.stop_stale_work,
+                                       self.reaper_interval, self.log)
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        # Started with the first request, not on environment upgrades
+        self.worker.start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
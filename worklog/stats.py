@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from functools import wraps
+from inspect import isgeneratorfunction
+from math import ceil
+from threading import Lock, local
+from time import time
+
+from trac.core import Component
+from trac.config import IntOption
+
+
+_local = local()
+
+
+class CountingCursor(object):
+    '''Cursor wrapper counting executed queries for the running
+    instrumented operations of the thread.'''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _count(self):
+        for counter in getattr(_local, 'counters', ()):
+            counter[0] += 1
+
+    def execute(self, sql, args=None):
+        self._count()
+        return self.cursor.execute(sql, args)
+
+    def executemany(self, sql, args):
+        self._count()
+        return self.cursor.executemany(sql, args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def counting_cursor(db):
+    '''Return a query counting cursor of `db`.'''
+    return CountingCursor(db.cursor())
+
+
+def instrumented(func):
+    '''Record wall time and query count of the calls of a component
+    method as `ClassName.method` operation. Generators are measured
+    until they are exhausted or closed.'''
+    def start():
+        counter = [0]
+        _local.__dict__.setdefault('counters', []).append(counter)
+        return counter, time()
+
+    def finish(component, counter, started):
+        seconds = time() - started
+        # Lists compare by value, so the counter is looked up by identity
+        counters = getattr(_local, 'counters', [])
+        for i, c in enumerate(counters):
+            if c is counter:
+                del counters[i]
+                break
+        WorkLogStats(component.env).record(
+            '%s.%s' % (component.__class__.__name__, func.__name__),
+            seconds, counter[0])
+
+    if isgeneratorfunction(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            counter, started = start()
+            try:
+                for item in func(self, *args, **kwargs):
+                    yield item
+            finally:
+                finish(self, counter, started)
+    else:
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            counter, started = start()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                finish(self, counter, started)
+    return wrapper
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of sorted `values`.'''
+    return values[max(int(ceil(len(values) * p / 100.0)) - 1, 0)]
+
+
+class OperationStats(object):
+    '''Wall times and query counts of the latest `samples` calls of
+    each operation.'''
+
+    def __init__(self, samples):
+        self.samples = samples
+        self._ops = {}
+        self._lock = Lock()
+
+    def record(self, name, seconds, queries):
+        with self._lock:
+            op = self._ops.get(name)
+            if op is None:
+                op = self._ops[name] = {'count': 0,
+                                        'samples': deque(maxlen=self.samples)}
+            op['count'] += 1
+            op['samples'].append((seconds, queries))
+
+    def clear(self):
+        with self._lock:
+            self._ops.clear()
+
+    def summary(self):
+        '''Return a list of dicts with `name`, `count` (calls since start),
+        `p50`, `p95`, `max` (seconds) and `queries` (average per call)
+        of each operation, ordered by name.'''
+        with self._lock:
+            ops = [(name, op['count'], list(op['samples']))
+                   for name, op in self._ops.items()]
+        rv = []
+        for name, count, samples in sorted(ops):
+            times = sorted(seconds for seconds, queries in samples)
+            rv.append({'name': name,
+                       'count': count,
+                       'p50': percentile(times, 50),
+                       'p95': percentile(times, 95),
+                       'max': times[-1],
+                       'queries': float(sum(q for s, q in samples)) / len(samples)})
+        return rv
+
+
+class WorkLogStats(Component):
+    '''Collects timings of the instrumented worklog operations and logs
+    the slow ones.'''
+
+    slow_threshold = IntOption('worklog', 'slow_threshold', 500,
+           '''Log worklog operations taking longer than this (in milliseconds, 0 to disable).''')
+    stats_samples = IntOption('worklog', 'stats_samples', 1000,
+           '''Number of latest calls of each worklog operation kept for the timing statistics.''')
+
+    def __init__(self):
+        self.stats = OperationStats(self.stats_samples)
+
+    def record(self, name, seconds, queries):
+        self.stats.record(name, seconds, queries)
+        threshold = self.slow_threshold
+        if threshold and seconds * 1000 >= threshold:
+            self.log.warning('Slow worklog operation %s: %d ms, %d queries',
+                             name, seconds * 1000, queries)
+
+    def summary(self):
+        return self.stats.summary()
+
+    def reset(self):
+        self.stats.clear()
@@ -0,0 +1,13 @@
+import unittest
+
+from worklog.tests import concurrency, notification
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(concurrency.suite())
+    suite.addTest(notification.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''Concurrent start of work.
+
+Needs a scratch EduTrac environment with the plugin enabled and
+upgraded, given by `WORKLOG_TEST_ENV` (path) and `WORKLOG_TEST_PROJECT`
+(project id). The open session uniqueness is enforced by partial
+unique indexes, so use a PostgreSQL backed environment. A project user
+owning at least two tickets in a work status is needed; the sessions
+made by the tests are deleted afterwards.
+'''
+import os
+import threading
+import unittest
+from time import time
+
+from trac.env import Environment
+
+from worklog.manager import WorkLogManager
+
+
+THREADS = 8
+
+
+class Barrier(object):
+    '''Lets `parties` threads continue once all of them are waiting.'''
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def wait(self, timeout=30):
+        deadline = time() + timeout
+        with self.cond:
+            self.waiting += 1
+            if self.waiting >= self.parties:
+                self.cond.notify_all()
+            while self.waiting < self.parties and time() < deadline:
+                self.cond.wait(deadline - time())
+
+
+class ConcurrentStartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        path = os.environ.get('WORKLOG_TEST_ENV')
+        pid = os.environ.get('WORKLOG_TEST_PROJECT')
+        if not path or not pid:
+            self.skipTest('WORKLOG_TEST_ENV and WORKLOG_TEST_PROJECT are not set')
+        self.env = Environment(path)
+        self.pid = int(pid)
+        self.mgr = WorkLogManager(self.env)
+        syllabus_id = self.mgr.pm.get_project_syllabus(self.pid)
+        self.settings = self.mgr.get_settings(syllabus_id)
+        # Starts must not stop each other's sessions
+        self.settings.autostopstart = False
+        self.started = int(time())
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        self.user = None
+        for user in sorted(self.mgr.pm.get_project_users(self.pid)):
+            cursor.execute('SELECT id FROM ticket WHERE project_id=%%s AND owner=%%s '
+                           'AND status IN (%s) ORDER BY id'
+                           % ','.join(['%s'] * len(self.settings.work_statuses)),
+                           [self.pid, user] + list(self.settings.work_statuses))
+            tickets = [row[0] for row in cursor]
+            if len(tickets) >= 2 and not self.mgr.get_active_task(user, self.pid):
+                self.user = user
+                self.tickets = tickets[:THREADS]
+                break
+        if self.user is None:
+            self.skipTest('No idle project user owning two workable tickets')
+        cursor.execute('SELECT ticket, starttime FROM work_log_latest '
+                       'WHERE project_id=%s AND worker=%s', (self.pid, self.user))
+        self.latest = cursor.fetchone()
+
+    def tearDown(self):
+        if getattr(self, 'user', None) is None:
+            return
+        self.mgr.reset_settings()
+
+        @self.env.with_transaction()
+        def do_cleanup(db):
+            cursor = db.cursor()
+            cursor.execute('DELETE FROM work_log WHERE worker=%s AND starttime>=%s',
+                           (self.user, self.started))
+            cursor.execute('DELETE FROM work_log_latest WHERE project_id=%s AND worker=%s',
+                           (self.pid, self.user))
+            if self.latest:
+                cursor.execute('INSERT INTO work_log_latest (project_id, worker, ticket, starttime) '
+                               'VALUES (%s, %s, %s, %s)', (self.pid, self.user) + tuple(self.latest))
+            self.mgr._bump_generation(db, self.pid)
+
+    def _start_concurrently(self, tickets):
+        '''Start work on `tickets` (one per thread) with all threads
+        passing the check before any of them writes.'''
+        barrier = Barrier(len(tickets))
+        check = self.mgr.can_work_on
+
+        def can_work_on(*args, **kwargs):
+            rv = check(*args, **kwargs)
+            barrier.wait()
+            return rv
+        self.mgr.can_work_on = can_work_on
+
+        results = [None] * len(tickets)
+
+        def run(i, tkt_id):
+            results[i] = self.mgr.start_work(self.user, tkt_id, self.started)
+
+        threads = [threading.Thread(target=run, args=(i, tkt_id))
+                   for i, tkt_id in enumerate(tickets)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(60)
+        finally:
+            del self.mgr.can_work_on
+        return results
+
+    def _open_sessions(self):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT ticket FROM work_log '
+                       'WHERE worker=%s AND project_id=%s AND endtime=0',
+                       (self.user, self.pid))
+        return [row[0] for row in cursor]
+
+    def _assert_one_winner(self, results):
+        self.assertEqual(1, len([res for res, err in results if res]))
+        for res, err in results:
+            if not res:
+                self.assertTrue('started concurrently' in err, err)
+        self.assertEqual(1, len(self._open_sessions()))
+
+    def test_same_ticket(self):
+        results = self._start_concurrently([self.tickets[0]] * THREADS)
+        self._assert_one_winner(results)
+        self.assertEqual([self.tickets[0]], self._open_sessions())
+
+    def test_same_worker(self):
+        results = self._start_concurrently(self.tickets)
+        self._assert_one_winner(results)
+        winner = [tkt_id for tkt_id, (res, err) in zip(self.tickets, results) if res]
+        self.assertEqual(winner, self._open_sessions())
+
+
+def suite():
+    return unittest.makeSuite(ConcurrentStartTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+'''Notification outbox draining, with a fake ticket notifier and
+through the ticket notification mail to a local SMTP server.'''
+import asyncore
+import smtpd
+import socket
+import threading
+import unittest
+from datetime import datetime
+
+from trac.resource import ResourceNotFound
+from trac.test import EnvironmentStub, Mock
+from trac.ticket import Ticket
+# Provides the notification mail templates
+from trac.ticket.web_ui import TicketModule
+from trac.util.datefmt import utc, to_utimestamp
+
+from worklog import notification
+from worklog.notification import WorkLogNotifier
+
+
+class FakeNotifier(object):
+    '''Stands in for the ticket notification mail, failing the first
+    `failures` sends.'''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.attempts = 0
+
+    def __call__(self, tkt, when):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError('SMTP server not available')
+        self.sent.append((tkt.id, when))
+
+
+class SMTPSink(smtpd.SMTPServer):
+    '''SMTP server on a free local port keeping the received mails.'''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.close()
+        self.thread.join(5)
+
+
+class NotificationOutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True, enable=['trac.*', 'worklog.*'])
+        self.env.config.set('worklog', 'notify_retries', 3)
+
+        @self.env.with_transaction()
+        def do_create(db):
+            cursor = db.cursor()
+            cursor.execute('CREATE TABLE work_log_notify ('
+                           'ticket       INTEGER,'
+                           'modtime      BIGINT,'
+                           'attempts     INTEGER,'
+                           'next_attempt INTEGER,'
+                           'error        TEXT,'
+                           'CONSTRAINT work_log_notify_pk PRIMARY KEY (ticket, modtime)'
+                           ')')
+
+        self.now = 1300000000
+        self._time = notification.time
+        notification.time = lambda: self.now
+        self.notifier = WorkLogNotifier(self.env)
+        self.notifier._get_ticket = lambda tkt_id: Mock(id=tkt_id)
+        self.when = datetime(2011, 3, 13, 7, 6, 40, tzinfo=utc)
+
+        @self.env.with_transaction()
+        def do_enqueue(db):
+            self.notifier.enqueue(db, Mock(id=1), self.when)
+
+    def tearDown(self):
+        notification.time = self._time
+
+        @self.env.with_transaction()
+        def do_drop(db):
+            db.cursor().execute('DROP TABLE work_log_notify')
+        self.env.reset_db()
+
+    def _outbox(self):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT ticket, modtime, attempts, next_attempt FROM work_log_notify')
+        return cursor.fetchall()
+
+    def test_sent(self):
+        fake = self.notifier.notify = FakeNotifier()
+        self.notifier.send_pending()
+        self.assertEqual([(1, self.when)], fake.sent)
+        self.assertEqual([], self._outbox())
+
+    def test_retry_backoff(self):
+        fake = self.notifier.notify = FakeNotifier(failures=2)
+        modtime = to_utimestamp(self.when)
+
+        self.notifier.send_pending()
+        self.assertEqual([(1, modtime, 1, self.now + 60)], self._outbox())
+
+        # Not due yet
+        self.now += 59
+        self.notifier.send_pending()
+        self.assertEqual(1, fake.attempts)
+
+        # Second failure doubles the delay
+        self.now += 1
+        self.notifier.send_pending()
+        self.assertEqual(2, fake.attempts)
+        self.assertEqual([(1, modtime, 2, self.now + 120)], self._outbox())
+
+        self.now += 120
+        self.notifier.send_pending()
+        self.assertEqual([(1, self.when)], fake.sent)
+        self.assertEqual([], self._outbox())
+
+    def test_gives_up(self):
+        fake = self.notifier.notify = FakeNotifier(failures=10)
+        for i in range(5):
+            self.notifier.send_pending()
+            self.now += 3600
+        self.assertEqual(3, fake.attempts)
+        self.assertEqual([], fake.sent)
+        self.assertEqual([], self._outbox())
+
+    def test_deleted_ticket(self):
+        fake = self.notifier.notify = FakeNotifier()
+        def get_ticket(tkt_id):
+            raise ResourceNotFound('Ticket %s does not exist.' % tkt_id)
+        self.notifier._get_ticket = get_ticket
+        self.notifier.send_pending()
+        self.assertEqual(0, fake.attempts)
+        self.assertEqual([], self._outbox())
+
+    def test_claimed_elsewhere(self):
+        fake = self.notifier.notify = FakeNotifier()
+        # Another process claims the row, then a stale claim fails
+        modtime = to_utimestamp(self.when)
+        self.assertTrue(self.notifier._claim(1, modtime, 0, self.now + 300))
+        self.assertFalse(self.notifier._claim(1, modtime, 0, self.now + 300))
+        self.notifier.send_pending()
+        self.assertEqual(0, fake.attempts)
+
+        # Sent once the lease of the other sender is over
+        self.now += 300
+        self.notifier.send_pending()
+        self.assertEqual([(1, self.when)], fake.sent)
+
+    def _smtp_ticket(self, port):
+        '''Point the ticket notification mail to `port` and make ticket
+        #1 with a change at the queued time.'''
+        for name, value in [('smtp_enabled', 'true'),
+                            ('smtp_server', '127.0.0.1'),
+                            ('smtp_port', port),
+                            ('smtp_from', 'trac@example.org'),
+                            ('always_notify_reporter', 'true')]:
+            self.env.config.set('notification', name, value)
+        del self.notifier._get_ticket
+        tkt = Ticket(self.env)
+        tkt['reporter'] = 'joe@example.org'
+        tkt['summary'] = 'Work log notification'
+        tkt.insert()
+        tkt.save_changes('joe', 'Work started.', self.when)
+        self.assertEqual(1, tkt.id)
+
+    def test_smtp_delivery(self):
+        smtp = SMTPSink()
+        try:
+            self._smtp_ticket(smtp.port)
+            self.notifier.send_pending()
+        finally:
+            smtp.stop()
+        self.assertEqual([], self._outbox())
+        self.assertEqual(1, len(smtp.messages))
+        mailfrom, rcpttos, data = smtp.messages[0]
+        self.assertEqual(['joe@example.org'], rcpttos)
+        self.assertTrue('Work started.' in data, data)
+
+    def test_smtp_unavailable(self):
+        # Nothing listens on a port just released
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self._smtp_ticket(port)
+        self.notifier.send_pending()
+        modtime = to_utimestamp(self.when)
+        self.assertEqual([(1, modtime, 1, self.now + 60)], self._outbox())
+
+    def test_worker_started_by_request(self):
+        started = []
+        self.notifier.worker = Mock(start=lambda: started.append(True))
+        self.notifier.pre_process_request(Mock(), None)
+        self.assertEqual([True], started)
+
+
+def suite():
+    return unittest.makeSuite(NotificationOutboxTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
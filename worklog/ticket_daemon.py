@@ -22,10 +22,10 @@ class WorkLogTicketObserver(Component):
         fields that have changed.
         """
         syllabus_id = ticket.syllabus_id
-        if self.mgr.autostop.syllabus(syllabus_id) \
+        if self.mgr.get_settings(syllabus_id).autostop \
                and 'closed' == ticket['status'] \
                and 'closed' != old_values.get('status'):
-            who, since = self.mgr.who_is_working_on(ticket.id)
+            who, since = self.mgr.who_is_working_on(ticket.id, ticket.pid)
             if who:
                 self.mgr.stop_work(who, ticket.pid)
 
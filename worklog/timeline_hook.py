@@ -8,7 +8,9 @@ from trac.ticket.api import TicketSystem
 from trac.timeline.api import ITimelineEventProvider
 from trac.wiki.formatter import format_to_oneliner
 from trac.resource import Resource
-from trac.web.chrome import add_stylesheet
+
+from bundles import WorkLogBundles
+from stats import counting_cursor, instrumented
 
 
 
@@ -23,71 +25,81 @@ class WorkLogTimelineAddon(Component):
             yield ('workstart', 'Work started', True)
             yield ('workstop', 'Work stopped', True)
 
+    @instrumented
     def get_timeline_events(self, req, start, stop, filters, pid, syllabus_id):
         if pid is None:
             return
-        is_multi = isinstance(pid, (list, tuple))
-        if is_multi:
-            # TODO:
-            return
+        # Events of several projects are fetched by a single query
+        if isinstance(pid, (list, tuple)):
+            pids = list(pid)
+            if not pids:
+                return
+        else:
+            pids = [pid]
 
         # Worklog changes
         show_starts = 'workstart' in filters
         show_stops = 'workstop' in filters
         if show_starts or show_stops:
-            add_stylesheet(req, "worklog/worklogplugin.css")
+            WorkLogBundles(self.env).add_bundle(req, 'worklog.css')
 
             ts_start = to_timestamp(start)
             ts_stop = to_timestamp(stop)
 
             ticket_realm = Resource('ticket')
             db = self.env.get_read_db()
-            cursor = db.cursor()
+            cursor = counting_cursor(db)
+
+            # Time range is applied in each branch, so the indexes on
+            # starttime and endtime are used and only needed kinds are read
+            queries = []
+            args = []
+            if show_starts:
+                queries.append("SELECT worker, ticket, starttime AS time, starttime, comment, 'start' AS kind "
+                               "FROM work_log "
+                               "WHERE starttime>=%s AND starttime<=%s")
+                args.extend((ts_start, ts_stop))
+            if show_stops:
+                queries.append("SELECT worker, ticket, endtime AS time, starttime, comment, 'stop' AS kind "
+                               "FROM work_log "
+                               "WHERE endtime>=%s AND endtime<=%s AND endtime<>0")
+                args.extend((ts_start, ts_stop))
+            args.extend(pids)
 
             cursor.execute("""
-                SELECT wl.worker,wl.ticket,wl.time,wl.starttime,wl.comment,wl.kind,t.summary,t.status,t.resolution,t.type
-                FROM (
-                    SELECT worker, ticket, starttime AS time, starttime, comment, 'start' AS kind
-                    FROM work_log
-                    UNION
-                    SELECT worker, ticket, endtime AS time, starttime, comment, 'stop' AS kind
-                    FROM work_log
-                ) AS wl
-                JOIN ticket t ON t.id = wl.ticket AND project_id=%s AND wl.time>=%s AND wl.time<=%s 
-                ORDER BY wl.time""", (pid, ts_start, ts_stop))
-
-            for worker,tid,ts,ts_start,comment,kind,summary,status,resolution,type in cursor:
+                SELECT wl.worker,wl.ticket,wl.time,wl.starttime,wl.comment,wl.kind,t.summary,t.status,t.resolution,t.type,t.project_id
+                FROM (%s) AS wl
+                JOIN ticket t ON t.id = wl.ticket AND t.project_id IN (%s)
+                ORDER BY wl.time""" % (' UNION ALL '.join(queries),
+                                       ','.join(['%s'] * len(pids))), args)
+
+            # Only raw values here, formatting is done for rendered events
+            for worker,tid,ts,ts_start,comment,kind,summary,status,resolution,type,pid in cursor:
                 ticket = ticket_realm(id=tid)
                 time = to_datetime(ts)
-                started = None
                 if kind == 'start':
-                    if not show_starts:
-                        continue
-                    yield ('workstart', pid, time, worker, (ticket,summary,status,resolution,type, started, ""))
+                    yield ('workstart', pid, time, worker, (ticket,summary,status,resolution,type, ts_start, None, None))
                 else:
-                    if not show_stops:
-                        continue
-                    started = to_datetime(ts_start)
-                    if comment:
-                        comment = "(Time spent: %s)\n\n%s" % (pretty_timedelta(started, time), comment)
-                    else:
-                        comment = '(Time spent: %s)' % pretty_timedelta(started, time)
-                    yield ('workstop', pid, time, worker, (ticket,summary,status,resolution,type, started, comment))
+                    yield ('workstop', pid, time, worker, (ticket,summary,status,resolution,type, ts_start, ts, comment))
 
     def render_timeline_event(self, context, field, event):
-        ticket,summary,status,resolution,type, started, comment = event[4]
+        ticket,summary,status,resolution,type, starttime, endtime, comment = event[4]
         if field == 'url':
             return context.href.ticket(ticket.id)
         elif field == 'title':
             title = TicketSystem(self.env).format_summary(summary, status,
                                                           resolution, type)
-            return tag('Work ', started and 'stopped' or 'started',
+            return tag('Work ', endtime and 'stopped' or 'started',
                        ' on Ticket ', tag.em('#', ticket.id, title=title),
                        ' (', shorten_line(summary), ') ')
         elif field == 'description':
+            if not endtime:
+                return ''
+            spent = '(Time spent: %s)' % pretty_timedelta(to_datetime(starttime),
+                                                          to_datetime(endtime))
+            if not comment:
+                return spent
             if self.config['timeline'].getbool('abbreviated_messages'):
                 comment = shorten_line(comment)
-            markup = format_to_oneliner(self.env, context(resource=ticket),
-                                        comment)
-            return markup
-
+            return tag(spent, ' ', format_to_oneliner(self.env, context(resource=ticket),
+                                                      comment))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from threading import Event, Lock, Thread
+
+from trac.util.text import exception_to_unicode
+
+
+def integrity_errors(env):
+    '''Return a tuple of IntegrityError classes of the database backends
+    `env` may be using.'''
+    db_exc = getattr(env, 'db_exc', None)
+    if db_exc is not None:
+        return (db_exc.IntegrityError,)
+    errors = []
+    for name in ('psycopg2', 'sqlite3', 'pysqlite2.dbapi2', 'MySQLdb'):
+        try:
+            module = __import__(name, fromlist=['IntegrityError'])
+        except ImportError:
+            continue
+        errors.append(module.IntegrityError)
+    return tuple(errors)
+
+
+class BackgroundWorker(object):
+    '''Daemon thread calling `func` every `interval` seconds, or sooner
+    when woken up. The thread is started on first `start` or `wakeup`.'''
+
+    def __init__(self, name, func, interval, log):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.log = log
+        self._event = Event()
+        self._lock = Lock()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._run, name=self.name)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def wakeup(self):
+        self.start()
+        self._event.set()
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self.func()
+            except Exception, e:
+                self.log.error('%s failed: %s', self.name, exception_to_unicode(e, traceback=True))
+            self._event.wait(self.interval)
+            self._event.clear()
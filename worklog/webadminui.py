@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from trac.ticket.admin import TicketAdminPanel
+from trac.util.text import printout
+
+from manager import WorkLogManager
+from stats import WorkLogStats
 
 
 class WorklogAdminPanel(TicketAdminPanel):
@@ -29,6 +33,9 @@ class WorklogAdminPanel(TicketAdminPanel):
                 self.config.set(self._type, 'roundup', roundup)
                 
             self.config.save()
+            WorkLogManager(self.env).reset_settings()
+        elif req.method == 'POST' and req.args.has_key('reset_stats'):
+            WorkLogStats(self.env).reset()
 
         settings = {}
         for yesno in bools:
@@ -38,10 +45,19 @@ class WorklogAdminPanel(TicketAdminPanel):
         if self.config.getint(self._type, 'roundup'):
             settings['roundup'] = self.config.getint(self._type, 'roundup')
         
+        settings['cache'] = WorkLogManager(self.env).active_cache.stats()
+        settings['operations'] = WorkLogStats(self.env).summary()
+
         settings['view'] = 'settings'
         return 'worklog_webadminui.html', settings
 
     # IAdminCommandProvider
 
     def get_admin_commands(self):
-        return None
+        yield ('worklog rollup rebuild', '',
+               'Recompute work log time rollups from the work log',
+               None, self._do_rollup_rebuild)
+
+    def _do_rollup_rebuild(self):
+        count = WorkLogManager(self.env).rebuild_rollups()
+        printout('Work log rollups rebuilt: %s rows' % count)
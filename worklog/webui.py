@@ -1,14 +1,24 @@
 import re
+from hashlib import sha1
+from time import time
 from StringIO import StringIO
 import csv
 
 from usermanual import user_manual_title, user_manual_wiki_title
-from manager import WorkLogManager
+from manager import WorkLogManager, format_log_cursor, parse_log_cursor
+from ticket_filter import WorkLogTicketAddon
+from bundles import WorkLogBundles
+from stats import instrumented
 from trac.core import *
+from trac.config import IntOption
 from trac.perm import IPermissionRequestor
+from trac.ticket import Ticket
 from trac.web import IRequestHandler
+from trac.web.api import RequestDone
+from trac.util.datefmt import to_datetime, to_timestamp, parse_date
 from trac.util import Markup
-from trac.web.chrome import add_stylesheet, INavigationContributor, ITemplateProvider
+from trac.util.presentation import to_json
+from trac.web.chrome import add_ctxtnav, INavigationContributor, ITemplateProvider
 
 from trac.project.api import ProjectManagement
 
@@ -17,6 +27,9 @@ class WorkLogPage(Component):
 
     implements(IPermissionRequestor, INavigationContributor, IRequestHandler, ITemplateProvider)
 
+    page_size = IntOption('worklog', 'page_size', 100,
+           '''Number of entries shown per page of the user work log.''')
+
     def __init__(self):
         self.mgr = WorkLogManager(self.env)
 
@@ -38,10 +51,110 @@ class WorkLogPage(Component):
                          (url , "Work Log"))
 
     # Internal Methods
-    def _worklog_csv(self, req, log):
+    def _get_filters(self, req):
+        '''Return (filters, args): work log filters parsed from the request
+        and the raw request arguments they came from (to keep them in links).
+
+        Supported arguments: `from`, `to` (dates), comma separated `users`,
+        `tickets`, `milestone` and `component` lists.'''
+        filters = {}
+        args = {}
+        for name in ('from', 'to'):
+            value = req.args.get(name)
+            if value:
+                filters[name] = to_timestamp(parse_date(value, req.tz))
+                args[name] = value
+        for name, key in (('users', 'users'),
+                          ('tickets', 'tickets'),
+                          ('milestone', 'milestones'),
+                          ('component', 'components')):
+            value = req.args.get(name)
+            if not value:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            values = [v.strip() for item in value for v in item.split(',') if v.strip()]
+            if not values:
+                continue
+            if key == 'tickets':
+                try:
+                    values = [int(v.lstrip('#')) for v in values]
+                except ValueError:
+                    raise TracError('Invalid ticket number in tickets filter')
+            filters[key] = values
+            args[name] = ','.join(unicode(v) for v in values)
+        return filters, args
+
+    def _worklog_changes(self, req, pid):
+        '''Send work log rows changed after `since` timestamp (or `cursor`)
+        as JSON, for clients keeping a copy of the work log in sync.
+        The returned `cursor` is the high-water mark to pass on the next
+        request; rows sharing a `lastchange` second may span pages, so
+        a timestamp can not be used for that.'''
+        try:
+            since = int(req.args.get('since') or 0)
+            limit = int(req.args.get('limit') or 500)
+        except ValueError:
+            raise TracError('Invalid since or limit argument')
+        limit = max(min(limit, 5000), 1)
+        try:
+            entries, cursor, more = self.mgr.get_changes(pid, since, req.args.get('cursor'), limit)
+        except ValueError:
+            raise TracError('Invalid work log cursor')
+        data = {'entries': entries,
+                'cursor': cursor,
+                'more': more}
+        req.send(to_json(data), 'application/json')
+
+    def _worklog_json(self, req, pid, username=None, filters=None, fmt='json'):
+        '''Stream the work log as a JSON array or, for `ndjson` format,
+        as one JSON object per line. Timestamps are UNIX timestamps,
+        `duration` is in seconds (until now for the open sessions).'''
+        req.send_response(200)
+        if fmt == 'ndjson':
+            req.send_header('Content-Type', 'application/x-ndjson')
+            start, sep, end = '', '\n', '\n'
+        else:
+            req.send_header('Content-Type', 'application/json')
+            start, sep, end = '[', ',\n', ']'
+        req.end_headers()
+
+        now = int(time())
+        content = [start]
+        size = 0
+        first = True
+        for user,starttime,endtime,ticket,summary,status,comment,lastchange \
+                in self.mgr.iter_work_log(pid, username, filters):
+            item = to_json({'user': user,
+                            'ticket': ticket,
+                            'summary': summary,
+                            'status': status,
+                            'comment': comment,
+                            'starttime': starttime,
+                            'endtime': endtime,
+                            'duration': (endtime or now) - starttime,
+                            'lastchange': lastchange})
+            if not first:
+                content.append(sep)
+            first = False
+            content.append(item)
+            size += len(item)
+            if size >= 8192:
+                req.write(''.join(content))
+                content = []
+                size = 0
+        if not first or fmt != 'ndjson':
+            content.append(end)
+        req.write(''.join(content))
+        raise RequestDone
+
+    def _worklog_csv(self, req, pid, username=None, filters=None):
         #req.send_header('Content-Type', 'text/plain')
+        req.send_response(200)
         req.send_header('Content-Type', 'text/csv;charset=utf-8')
         req.send_header('Content-Disposition', 'filename=worklog.csv')
+        # No Content-Length: rows are sent while they are fetched
+        req.end_headers()
 
         # Headers
         fields = ['user',
@@ -57,21 +170,39 @@ class WorkLogPage(Component):
         writer.writerow([unicode(c).encode('utf-8') for c in fields])
 
         # Rows
-        for row in log:
-            values=[]
-            for field in fields:
-                values.append(unicode(row[field]).encode('utf-8'))
-            writer.writerow(values)
+        for user,starttime,endtime,ticket,summary,status,comment,lastchange \
+                in self.mgr.iter_work_log(pid, username, filters):
+            values = [user,
+                      to_datetime(starttime),
+                      endtime and to_datetime(endtime),
+                      ticket,
+                      summary,
+                      comment]
+            writer.writerow([unicode(v).encode('utf-8') for v in values])
+            if content.tell() >= 8192:
+                req.write(content.getvalue())
+                content.seek(0)
+                content.truncate()
 
-        req.send_header('Content-Length', content.len)
         req.write(content.getvalue())
+        raise RequestDone
 
     # IRequestHandler
 
     def match_request(self, req):
         return req.path_info.startswith('/worklog')
 
+    @instrumented
     def process_request(self, req):
+        pm = ProjectManagement(self.env)
+        self.pm = pm
+
+        # Work state of the ticket page, needs WORK_LOG only
+        match = re.search('/worklog/status/([0-9]+)', req.path_info)
+        if match:
+            tkt_id = match.group(1)
+            return self._work_status(req, tkt_id)
+
         req.perm.require('WORK_VIEW')
         
         messages = []
@@ -79,15 +210,19 @@ class WorkLogPage(Component):
         def addMessage(s):
             messages.extend([s]);
 
-        pm = ProjectManagement(self.env)
-        self.pm = pm
         pid = pm.get_current_project(req)
         pm.check_component_enabled(self, pid=pid)
 
-        add_stylesheet(req, "worklog/worklogplugin.css")
+        WorkLogBundles(self.env).add_bundle(req, 'worklog.css')
 
         # Specific pages
 
+        if req.path_info == '/worklog/summary':
+            return self._summary(req, pid)
+
+        if req.path_info == '/worklog/report':
+            return self._report(req, pid)
+
         match = re.search('/worklog/users/(.*)', req.path_info)
         if match:
             username = match.group(1)
@@ -100,8 +235,14 @@ class WorkLogPage(Component):
 
 
         username = req.authname
+        filters, filter_args = self._get_filters(req)
         if req.args.has_key('format') and req.args['format'] == 'csv':
-            return self._worklog_csv(req, self.mgr.get_work_log(pid))
+            return self._worklog_csv(req, pid, filters=filters)
+        fmt = req.args.get('format')
+        if fmt == 'json' and ('since' in req.args or 'cursor' in req.args):
+            return self._worklog_changes(req, pid)
+        if fmt in ('json', 'ndjson'):
+            return self._worklog_json(req, pid, filters=filters, fmt=fmt)
 
         # Not any specific page, so process POST actions here.
         if req.method == 'POST':
@@ -125,9 +266,14 @@ class WorkLogPage(Component):
                 req.redirect(req.args.get('source_url'))
 
         # no POST, so they're just wanting a list of the worklog entries
+        add_ctxtnav(req, 'Time Summary', req.href.worklog('summary'))
+        add_ctxtnav(req, 'Report', req.href.worklog('report', **filter_args))
         data = {"messages": messages,
-                "worklog": self.mgr.get_work_log(pid, mode='latest'),
+                "worklog": self.mgr.get_work_log(pid, mode='latest', filters=filters),
                 "worklog_href": req.href.worklog(),
+                "filters": filter_args,
+                "csv_href": req.href.worklog(format='csv', **filter_args),
+                "json_href": req.href.worklog(format='json', **filter_args),
                 "ticket_href": req.href.ticket(),
                 "usermanual_href": req.href.wiki(user_manual_wiki_title),
                 "usermanual_title": user_manual_title
@@ -139,26 +285,141 @@ class WorkLogPage(Component):
         if username not in users:
             raise TracError('You can not view work log for users from other projects')
 
-        worklog = self.mgr.get_work_log(pid, username, mode='user')
-
+        filters, filter_args = self._get_filters(req)
         if req.args.has_key('format') and req.args['format'] == 'csv':
-            return self._worklog_csv(req, worklog)
+            return self._worklog_csv(req, pid, username, filters)
+        if req.args.get('format') in ('json', 'ndjson'):
+            return self._worklog_json(req, pid, username, filters, req.args['format'])
+
+        before = after = None
+        try:
+            if req.args.get('before'):
+                before = parse_log_cursor(req.args['before'])
+            elif req.args.get('after'):
+                after = parse_log_cursor(req.args['after'])
+        except ValueError:
+            raise TracError('Invalid work log page cursor')
+
+        # Fetch one extra entry to know if there is one more page
+        limit = max(self.page_size, 1)
+        worklog = self.mgr.get_work_log(pid, username, mode='user', limit=limit + 1,
+                                        before=before, after=after, filters=filters)
+        if after:
+            has_prev = len(worklog) > limit
+            has_next = True
+            worklog = worklog[-limit:]
+        else:
+            has_prev = bool(before)
+            has_next = len(worklog) > limit
+            worklog = worklog[:limit]
+
+        prev_href = next_href = None
+        if worklog:
+            if has_prev:
+                prev_href = req.href.worklog('users', username, after=format_log_cursor(worklog[0]),
+                                             **filter_args)
+            if has_next:
+                next_href = req.href.worklog('users', username, before=format_log_cursor(worklog[-1]),
+                                             **filter_args)
 
         data = {"worklog": worklog,
                 "username": username,
+                "prev_href": prev_href,
+                "next_href": next_href,
+                "filters": filter_args,
+                "csv_href": req.href.worklog('users', username, format='csv', **filter_args),
+                "json_href": req.href.worklog('users', username, format='json', **filter_args),
                 "ticket_href": req.href.ticket(),
                 "usermanual_href": req.href.wiki(user_manual_wiki_title),
                 "usermanual_title": user_manual_title
                 }
         return 'worklog_user.html', data, None
 
+    def _summary(self, req, pid):
+        groups = [('user', 'User'),
+                  ('ticket', 'Ticket'),
+                  ('day', 'Day'),
+                  ('week', 'Week')]
+        group = req.args.get('group', 'user')
+        if group not in dict(groups):
+            raise TracError('Unknown summary grouping "%s"' % group)
+
+        filters, filter_args = self._get_filters(req)
+        for name in ('milestone', 'component'):
+            if name in filter_args:
+                raise TracError('Time summary can not be filtered by %s' % name)
+
+        add_ctxtnav(req, 'Work Log', req.href.worklog())
+        add_ctxtnav(req, 'Report', req.href.worklog('report', **filter_args))
+        data = {"title": 'Time Summary',
+                "summary": self.mgr.get_summary(pid, group, filters),
+                "group": group,
+                "groups": groups,
+                "group_hrefs": dict((name, req.href.worklog('summary', group=name, **filter_args))
+                                    for name, label in groups),
+                "filters": filter_args,
+                "show_ticket_filters": False,
+                "worklog_href": req.href.worklog(),
+                "ticket_href": req.href.ticket(),
+                "usermanual_href": req.href.wiki(user_manual_wiki_title),
+                "usermanual_title": user_manual_title
+                }
+        return 'worklog_summary.html', data, None
+
+    def _report(self, req, pid):
+        groups = [('user', 'User'),
+                  ('ticket', 'Ticket'),
+                  ('milestone', 'Milestone'),
+                  ('component', 'Component'),
+                  ('week', 'Week')]
+        group = req.args.get('group', 'user')
+        if group not in dict(groups):
+            raise TracError('Unknown report grouping "%s"' % group)
+
+        filters, filter_args = self._get_filters(req)
+
+        add_ctxtnav(req, 'Work Log', req.href.worklog())
+        add_ctxtnav(req, 'Time Summary', req.href.worklog('summary'))
+        data = {"title": 'Time Report',
+                "summary": self.mgr.get_report(pid, group, filters),
+                "group": group,
+                "groups": groups,
+                "group_hrefs": dict((name, req.href.worklog('report', group=name, **filter_args))
+                                    for name, label in groups),
+                "filters": filter_args,
+                "show_ticket_filters": True,
+                "worklog_href": req.href.worklog(),
+                "ticket_href": req.href.ticket(),
+                "milestone_href": req.href.milestone(),
+                "usermanual_href": req.href.wiki(user_manual_wiki_title),
+                "usermanual_title": user_manual_title
+                }
+        return 'worklog_summary.html', data, None
+
+    def _work_status(self, req, tkt_id):
+        req.perm.require('WORK_LOG')
+        ticket = Ticket(self.env, tkt_id)
+        req.perm(ticket.resource).require('TICKET_VIEW')
+        self.pm.check_component_enabled(self, pid=ticket.pid)
+
+        status = WorkLogTicketAddon(self.env).get_status(req, ticket)
+        body = to_json(status)
+        # Times in the state texts are relative, so the content takes
+        # part in the ETag along with the ticket change time
+        req.check_modified(ticket['changetime'], sha1(body).hexdigest())
+        req.send_header('Cache-Control', 'private, no-cache')
+        req.send(body, 'application/json')
+
     def _work_stop(self, req, tkt_id):
         data = {'worklog_href': req.href.worklog(),
                 'ticket_href':  req.href.ticket(tkt_id),
                 'ticket':       tkt_id,
                 'xhr':          req.is_ajax,
+                'fragment':     req.is_ajax and 'fragment' in req.args,
                 'action':       'stop',
                 'label':        'Stop Work'}
+        if data['fragment']:
+            return 'worklog_stop_form.html', data, None
         return 'worklog_stop.html', data, None
 
     # ITemplateProvider
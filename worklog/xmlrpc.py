@@ -1,7 +1,7 @@
 import xmlrpclib
 import posixpath
 
-from manager import WorkLogManager
+from manager import WorkLogManager, format_log_cursor, parse_log_cursor
 
 from trac.core import *
 from trac.perm import IPermissionRequestor
@@ -25,6 +25,15 @@ class WorlLogRPC(Component):
         yield ('WIKI_VIEW', ((dict, int), (dict, int, str),), self.getActiveTask)
         yield ('WIKI_VIEW', ((str, int,),), self.whoIsWorkingOn)
         yield ('WIKI_VIEW', ((str, int,),), self.whoLastWorkedOn)
+        yield ('WIKI_VIEW', ((dict, list),), self.whoIsWorkingOnMany)
+        yield ('WIKI_VIEW', ((dict, int, list),), self.getActiveTasks)
+        yield ('WIKI_VIEW', ((dict, int), (dict, int, int), (dict, int, int, int),
+                             (dict, int, int, int, int), (dict, int, int, int, int, str),), self.getWorkLog)
+        yield ('WIKI_VIEW', ((dict, int, int), (dict, int, int, str), (dict, int, int, str, int),), self.getChanges)
+        yield ('WIKI_VIEW', ((list, int), (list, int, str), (list, int, str, int),
+                             (list, int, str, int, int),), self.getReport)
+        yield ('WIKI_VIEW', ((list, list),), self.startWorkMany)
+        yield ('WIKI_VIEW', ((list, list), (list, list, str), (list, list, str, int),), self.stopWorkMany)
 
     def getRPCVersionSupported(self, req):
         """ Returns 1 with this version of the Work Log XMLRPC API. """
@@ -67,3 +76,74 @@ class WorlLogRPC(Component):
         """ Returns the username of the person last worked on the given ticket """
         return self.mgr.who_last_worked_on(ticket)
             
+
+    def whoIsWorkingOnMany(self, req, tickets):
+        """ Returns a structure mapping ticket numbers (as strings) to the username of the person currently working on it, tickets nobody works on are omitted """
+        working = self.mgr.who_is_working_on_many(tickets)
+        return dict((str(ticket), who) for ticket, (who, since) in working.iteritems())
+
+    def getActiveTasks(self, req, pid, usernames):
+        """ Returns a structure mapping usernames to their active task info (see getActiveTask), users not working are omitted """
+        return self.mgr.get_active_tasks(usernames, pid)
+
+    def getWorkLog(self, req, pid, since=0, until=0, limit=100, cursor=''):
+        """ Returns a page of the work log of the project: {'entries': [...], 'cursor': str}.
+        Entries are ordered by last change, newest first, and limited to work started in [since, until) if given (seconds since epoch).
+        Pass the returned cursor to get the next page, it is empty on the last page. """
+        filters = {}
+        if since:
+            filters['from'] = since
+        if until:
+            filters['to'] = until
+        before = cursor and parse_log_cursor(cursor) or None
+        limit = max(min(limit, 1000), 1)
+        log = self.mgr.get_work_log(pid, limit=limit + 1, before=before, filters=filters)
+        entries = []
+        for entry in log[:limit]:
+            entries.append({'user': entry['user'],
+                            'ticket': entry['ticket'],
+                            'summary': entry['summary'],
+                            'status': entry['status'],
+                            'comment': entry['comment'] or '',
+                            'starttime': entry.start,
+                            'endtime': entry.end,
+                            'lastchange': entry['lastchange']})
+        next_cursor = ''
+        if len(log) > limit:
+            next_cursor = format_log_cursor(log[limit - 1])
+        return {'entries': entries, 'cursor': next_cursor}
+
+    def getChanges(self, req, pid, since, cursor='', limit=500):
+        """ Returns work log entries of the project changed after since (seconds since epoch), oldest change first: {'entries': [...], 'cursor': str, 'more': bool}.
+        Pass the returned cursor (the high-water mark) on the next call to get only newer changes. """
+        entries, cursor, more = self.mgr.get_changes(pid, since, cursor,
+                                                     max(min(limit, 5000), 1))
+        for entry in entries:
+            entry['comment'] = entry['comment'] or ''
+        return {'entries': entries, 'cursor': cursor or '', 'more': more}
+
+    def getReport(self, req, pid, group='user', since=0, until=0):
+        """ Returns time spent in the project grouped by 'user', 'ticket', 'milestone', 'component' or 'week': [{'group': value, 'seconds': int, 'sessions': int}, ...].
+        Only work started in [since, until) is counted if given (seconds since epoch), unfinished work is counted up to now. """
+        if group not in self.mgr.report_groups:
+            raise TracError('Unknown report grouping "%s"' % group)
+        filters = {}
+        if since:
+            filters['from'] = since
+        if until:
+            filters['to'] = until
+        rows = self.mgr.get_report(pid, group, filters)
+        for row in rows:
+            if row['group'] is None:
+                row['group'] = ''
+        return rows
+
+    def startWorkMany(self, req, tickets):
+        """ Start work on several tickets in a single transaction. Returns a list with the string 'OK' or an explanation for each ticket (requires authentication)"""
+        return [res and 'OK' or err
+                for res, err in self.mgr.start_work_many(req.authname, tickets)]
+
+    def stopWorkMany(self, req, pids, comment=None, stoptime=None):
+        """ Stops work in several projects in a single transaction. Returns a list with the string 'OK' or an explanation for each project (requires authentication, stoptime is seconds since epoch) """
+        return [res and 'OK' or err
+                for res, err in self.mgr.stop_work_many(req.authname, pids, stoptime, comment)]